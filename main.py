@@ -1,13 +1,78 @@
+import json
 from argparse import ArgumentParser
 
 from pyxiv import PyxivSpider, PyxivConfig
+from pyxivdaemon import PyxivClient, PyxivDaemon
+
+
+def parse_value(value: str):
+    """Parse a command line argument as json, or keep it as a string"""
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--config", type=str, default="config.json", help="a json file which stores pyxiv configs")
+    parser.add_argument("--address", type=str, default=None, help="socket of daemon, default to address in daemon of config")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("daemon", help="run a daemon which keeps spider warm and runs submitted jobs")
+
+    submit_parser = subparsers.add_parser("submit", help="submit a job to daemon, e.g. submit download_user 123 ./out")
+    submit_parser.add_argument("method", type=str, help="method of PyxivSpider, crawl_*, download_*, update_*, save_*, ...")
+    submit_parser.add_argument("args", nargs="*", help="arguments of method, parsed as json if possible, key=value for keyword arguments")
+    submit_parser.add_argument("--priority", type=int, default=0, help="jobs of higher priority run first")
+    submit_parser.add_argument("--follow", action="store_true", help="print output of the job until it finishes")
+
+    follow_parser = subparsers.add_parser("follow", help="print output of a job until it finishes")
+    follow_parser.add_argument("job_id", type=int)
+
+    cancel_parser = subparsers.add_parser("cancel", help="cancel a queued job")
+    cancel_parser.add_argument("job_id", type=int)
+
+    jobs_parser = subparsers.add_parser("jobs", help="list jobs")
+    jobs_parser.add_argument("--states", nargs="*", default=None, help="queued, running, done, failed, cancelled")
+    jobs_parser.add_argument("--limit", type=int, default=20)
+
     args = parser.parse_args()
 
-    spider = PyxivSpider(args.config)
+    if args.command == "daemon":
+        PyxivDaemon(args.config, args.address).serve_forever()
+    elif args.command:
+        daemon_config = PyxivConfig(args.config).daemon or {}
+        address = args.address or daemon_config.get("address") or "./pyxiv.sock"
+        client = PyxivClient(address, daemon_config.get("token"))
+        job_id = None
+        if args.command == "submit":
+            method_args = [parse_value(e) for e in args.args if "=" not in e or e.startswith(("{", "["))]
+            method_kwargs = dict(
+                (e.split("=", 1)[0], parse_value(e.split("=", 1)[1])) for e in args.args if "=" in e and not e.startswith(("{", "["))
+            )
+            job_id = client.submit(args.method, *method_args, priority=args.priority, **method_kwargs)
+            print("Job: {}".format(job_id))
+            if not args.follow:
+                job_id = None
+        elif args.command == "follow":
+            job_id = args.job_id
+        elif args.command == "cancel":
+            print("Cancelled" if client.cancel(args.job_id) else "Not queued")
+        elif args.command == "jobs":
+            for job in client.list(args.states, args.limit):
+                print("{id}\t{state}\t{priority}\t{method}\t{args}\t{kwargs}\t{error}".format(**job))
+
+        if job_id is not None:
+            follow = client.follow(job_id)
+            try:
+                while True:
+                    print(next(follow))
+            except StopIteration as e:
+                job = e.value or {}
+                print("{}: {}".format(job.get("state"), job.get("error") or job.get("result")))
+    else:
+        spider = PyxivSpider(args.config)
 
-    # use methods with spider to download pixiv illusts
-    print(help(spider))
\ No newline at end of file
+        # use methods with spider to download pixiv illusts
+        print(help(spider))
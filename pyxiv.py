@@ -1,10 +1,18 @@
+import contextvars
+import json
+import logging
 import os
-import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+import pyxivtrace
 import wrapper
-from pyxivbase import PyxivBrowser, PyxivConfig, PyxivDatabase
+from pyxivbase import (
+    PyxivBrowser, PyxivConfig, PyxivDatabase, PyxivIllustCache, PyxivRequestCounter, PyxivResultCache, PyxivSeedSampler
+)
+from pyxivimage import Image, PyxivImageProcessor, dhash
+from pyxivpipeline import PyxivPipeline
 
 
 class PyxivSpider:
@@ -20,17 +28,43 @@ class PyxivSpider:
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.98 Safari/537.36",
     }
 
+    # page sizes from large to small, same as keys of urls in illust pages
+    page_sizes = ["original", "regular", "small", "thumb_mini"]
+
+    # seconds to reuse expansion results stored in database before fetching again, empty results are not stored
+    edge_max_age = 30 * 86400
+
+    # search category -> (method of browser, key of results in body)
+    search_categories = {
+        "artworks": ("get_search_artworks", "illustManga"),
+        "illustrations": ("get_search_illustrations", "illust"),
+        "manga": ("get_search_manga", "manga"),
+    }
+    search_page_size = 60
+
     def __init__(self, config_path):
         self.config = PyxivConfig(config_path)
-        self.browser = PyxivBrowser(self.config.proxies, self.config.cookies)
-        self.db = PyxivDatabase(self.config.db_path)
+        self.logger = logging.getLogger(__name__)
+        self.browser = PyxivBrowser(
+            self.config.proxies, self.config.cookies, rate_limit=self.config.rate_limit, cassette=self.config.cassette
+        )
+        self.db = PyxivDatabase(self.config.db_path, shard_max_illusts=self.config.shard_max_illusts)
+        self.search_results = PyxivResultCache(self.db)
+        self.illusts = PyxivIllustCache(self.db)
+        self.seeds = PyxivSeedSampler(self.db)
+        self.id_index = None  # PyxivIdIndex, set by long running processes to skip reading all ids for each crawl
+        self.processor = PyxivImageProcessor(self.db, **self.config.post_process) if self.config.post_process else None
 
         self.browser.headers.update(self.headers)
+        if self.config.trace:
+            pyxivtrace.tracer.enable(**self.config.trace)
 
     # Save methods begin here
     # Used to save metadata to database, without downloading real pictures
 
-    def search_cache(self, keywords: list = None, scope="tag", mode="all", match="fuzzy", query="and", order="like"):
+    def search_cache(
+            self, keywords: list = None, scope="tag", mode="all", match="fuzzy", query="and", order="like",
+            offset: int = 0, limit: int = None):
         """Search database for cache result
 
         Args:
@@ -39,10 +73,15 @@ class PyxivSpider:
             mode: "safe", "r18", "all"
             match: "fuzzy", "exactly"
             query: "and", "or"
-            order: "like", "bookmark", "view"
+            order: "like", "bookmark", "view", "trending"
+            offset: Start index of result
+            limit: Max length of result, None means all
 
         Returns:
             A list consist of two-tuples, like (illust_id, key), where key is specified by order
+
+        Note:
+            Results are memoized until any insert_* to database, so paging through the same search is cheap.
         """
 
         # check value
@@ -50,7 +89,7 @@ class PyxivSpider:
         mode_values = ["safe", "r18", "all"]
         match_values = ["fuzzy", "exactly"]
         query_values = ["and", "or"]
-        order_values = ["like", "bookmark", "view"]
+        order_values = ["like", "bookmark", "view", "trending"]
         if scope not in scope_values:
             raise ValueError("Incorrect scope value: {}".format(scope))
         if mode not in mode_values:
@@ -62,11 +101,23 @@ class PyxivSpider:
         if order not in order_values:
             raise ValueError("Incorrect order value: {}".format(order))
 
+        # keywords order and duplicates don't change the result
+        keywords = sorted(set(keywords or []))
+        key = json.dumps([keywords, scope, mode, match, query, order], ensure_ascii=False)
+        generation = self.db.generation
+        result = self.search_results.get(key, generation)
+        if result is None:
+            result = self._search_cache(keywords, scope, mode, match, query, order)
+            self.search_results.put(key, generation, result)
+        return result[offset:] if limit is None else result[offset: offset + limit]
+
+    def _search_cache(self, keywords, scope, mode, match, query, order) -> list:
         # prepare for sql command
         o_value = {
             "like": "like_count",
             "bookmark": "bookmark_count",
-            "view": "view_count"
+            "view": "view_count",
+            "trending": "IFNULL((SELECT score FROM illust_trending WHERE illust_id = illust.id), 0)"
         }
         m_where = {
             "fuzzy": {
@@ -81,7 +132,10 @@ class PyxivSpider:
 
         # sql command
         sql_full = "SELECT id, {order} FROM illust;".format(order=o_value[order])
-        sql_tag = "SELECT DISTINCT id, {order} FROM illust JOIN tag ON illust.id = tag.illust_id WHERE {where};".format(
+        sql_tag = (
+            "SELECT DISTINCT id, {order} FROM illust JOIN illust_tag ON illust.id = illust_tag.illust_id "
+            "WHERE tag_id IN (SELECT id FROM tag_name WHERE {where});"
+        ).format(
             order=o_value[order],
             where=m_where[match]["tag"])
         sql_td = "SELECT id, {order} FROM illust WHERE {where};".format(
@@ -137,6 +191,7 @@ class PyxivSpider:
         result = sorted(result_set, key=lambda e: e[1], reverse=True)
         return result
 
+    @pyxivtrace.traced()
     @wrapper.log_calling_info()
     def save_illust(self, illust_id) -> bool:
         """Store or update full information of an illust, may affect all tables in database
@@ -146,15 +201,20 @@ class PyxivSpider:
 
         Returns:
             bool: Return True if the illust information has been fully stored in database, else False
+
+        Raises:
+            sqlite3.Error: if failed to store the illust
         """
         illust = self.browser.get_illust(illust_id)
         pages = self.browser.get_illust_pages(illust_id)
         # only store complete illust information
         if illust and pages:
+            futures = []
+
             # insert user
             user_id = illust.get("userId")
             user_name = illust.get("userName")
-            self.db.insert_user(user_id, user_name)
+            futures.append(self.db.insert_user(user_id, user_name))
 
             # insert illust
             illust_title = illust.get("title")
@@ -164,29 +224,36 @@ class PyxivSpider:
             view_count = illust.get("viewCount")
             x_restrict = illust.get("xRestrict")
             upload_date = illust.get("uploadDate")
-            self.db.insert_illust(
+            futures.append(self.db.insert_illust(
                 illust_id, illust_title, illust_description,
                 bookmark_count, like_count, view_count,
                 user_id, x_restrict, upload_date
-            )
+            ))
 
             # insert page
-            page_urls = [page.get("urls").get("original") for page in pages]
-            for page_id, url_original in enumerate(page_urls):
-                self.db.insert_page(illust_id, page_id, url_original)
+            for page_id, page in enumerate(pages):
+                urls = page.get("urls")
+                futures.append(self.db.insert_page(illust_id, page_id, *(urls.get(size) or "" for size in self.page_sizes)))
 
             # insert tag
             tags = [tag.get("tag") for tag in illust.get("tags").get("tags")]
-            for name in tags:
-                self.db.insert_tag(name, illust_id)
-
+            futures.append(self.db.insert_tags(tags, illust_id))
+
+            # wait until committed
+            with pyxivtrace.span("db_wait"):
+                for future in futures:
+                    future.result()
+            self.illusts.invalidate(illust_id)
+            if self.id_index:
+                self.id_index.add(illust_id, user_id)
             return True
         else:
             return False
 
+    @pyxivtrace.traced()
     @wrapper.log_calling_info()
     def save_user(self, user_id) -> bool:
-        """Save illusts information of a user, excluding existing illusts
+        """Save illusts information of a user, excluding existing illusts, and record the sync in user_sync
 
         Returns:
             bool: Return True if the user information has been stored in database, else False
@@ -201,6 +268,11 @@ class PyxivSpider:
             for illust_id in all_illust_ids.difference(exist_illust_ids):
                 if self.save_illust(illust_id):
                     result = True
+
+            sync = self.db.get_user_sync(user_id)
+            max_illust_id = max(all_illust_ids, default=0)
+            new_count = len([i for i in all_illust_ids if i > sync[1]]) if sync else 0
+            self.db.insert_user_sync(int(user_id), max(max_illust_id, sync[1] if sync else 0), len(all_illust_ids), new_count).result()
         return result
 
     def save_top_illust(
@@ -216,7 +288,10 @@ class PyxivSpider:
         top_illust = self.browser.get_top_illust(mode)
         if top_illust:
             page_info = top_illust.get("page")
-            exist_illust_ids = [row[0] for row in self.db("SELECT id FROM illust")]
+            if self.id_index:
+                exist_illust_ids = self.id_index.illust_ids()
+            else:
+                exist_illust_ids = [row[0] for row in self.db("SELECT id FROM illust")]
             illust_ids = []
             if f_tags:
                 for e in page_info.get("tags"):
@@ -240,11 +315,30 @@ class PyxivSpider:
             for illust_id in illust_ids:
                 self.save_illust(illust_id)
 
-    def save_all(self):
-        """Save all illusts information of all users stored in database, excluding existing illusts"""
-        user_ids = [row[0] for row in self.db("SELECT id FROM user")]
-        for user_id in user_ids:
-            self.save_user(user_id)
+    def save_all(self, budget: int = None, due_only: bool = True) -> int:
+        """Save illusts information of users stored in database, excluding existing illusts
+
+        Users are synced in order of user_sync schedule, active users are checked often and dormant ones rarely.
+
+        Args:
+            budget: Max number of requests of this call, including requests replayed from cassette, None for no limit
+            due_only: Only sync users due by schedule, False to sync all users
+
+        Returns:
+            int: Number of users synced
+        """
+        user_ids = self.db.get_due_users() if due_only else [row[0] for row in self.db("SELECT id FROM user")]
+        print("{} users need to be synced...".format(len(user_ids)))
+        count = 0
+        # counts only requests of this call, other jobs of a daemon share the browser
+        with PyxivRequestCounter() as counter:
+            for user_id in user_ids:
+                if budget is not None and counter.count >= budget:
+                    break
+                self.save_user(user_id)
+                count += 1
+        print("Synced: {}".format(count))
+        return count
 
     def update_illusts_info(self):
         """Update information of all illusts stored in database"""
@@ -287,22 +381,177 @@ class PyxivSpider:
                 view_count = illust.get("viewCount")
                 x_restrict = illust.get("xRestrict")
                 upload_date = illust.get("uploadDate")
-                self.db.insert_illust(
+                future = self.db.insert_illust(
                     illust_id, illust_title, illust_description,
                     bookmark_count, like_count, view_count,
                     user_id, x_restrict, upload_date
                 )
                 # update tag
                 tags = [tag.get("tag") for tag in illust.get("tags").get("tags")]
-                for name in tags:
-                    self.db.insert_tag(name, illust_id)
+                self.db.insert_tags(tags, illust_id).result()
+                future.result()
+
+    @pyxivtrace.traced()
+    def _backfill_ranking_date(self, date, mode, content) -> int:
+        """Fetch all pages of a ranking and store them
+
+        Returns:
+            int: Number of illusts stored, -1 if failed
+        """
+        contents = []
+        ranking = {}
+        p = 1
+        while p:
+            ranking = self.browser.get_ranking(p, content, mode, date)
+            if not ranking:
+                return -1
+            contents.extend(ranking.get("contents"))
+            p = ranking.get("next")  # next page number or False
+
+        # the newest ranking is returned for dates not available yet
+        if ranking.get("date") != date:
+            return -1
+        self.db.insert_ranking(date, mode, content, contents, ranking.get("rank_total") or len(contents)).result()
+        return len(contents)
+
+    def backfill_ranking(self, start_date, end_date, modes: list = None, contents: list = None, step: int = 1, workers: int = None) -> int:
+        """Store rankings of a date range into table ranking, without get_illust for each illust
+
+        Args:
+            start_date, end_date: first and last ranking date, both included, example: 20210319
+            modes: list of mode of get_ranking, default to ["daily"]
+            contents: list of content of get_ranking, default to ["all"]
+            step: days between each date
+            workers: number of rankings fetched in parallel, default to max concurrency of browser
+
+        Returns:
+            int: Number of rankings stored
+
+        Note:
+            Rankings already stored are skipped, a ranking is stored only after all its pages are fetched.
+        """
+        start_date = datetime.strptime(str(start_date), "%Y%m%d")
+        end_date = datetime.strptime(str(end_date), "%Y%m%d")
+        modes = modes or ["daily"]
+        contents = contents or ["all"]
+        workers = workers or self.browser.rate_controller.max_concurrency
+
+        fetched = set(self.db("SELECT date, mode, content FROM ranking_fetch;"))
+        tasks = []
+        date = start_date
+        while date <= end_date:
+            for mode in modes:
+                for content in contents:
+                    task = (date.strftime("%Y%m%d"), mode, content)
+                    if task not in fetched:
+                        tasks.append(task)
+            date += timedelta(days=step)
+
+        print("{} rankings need to be fetched...".format(len(tasks)))
+        stored = 0
+        with ThreadPoolExecutor(workers) as executor:
+            # workers inherit context of caller, e.g. log of a daemon job
+            futures = {
+                executor.submit(contextvars.copy_context().run, self._backfill_ranking_date, *task): task for task in tasks
+            }
+            for future in as_completed(futures):
+                try:
+                    if future.result() >= 0:
+                        stored += 1
+                    else:
+                        print("Failed:{}".format(futures[future]))
+                except Exception as e:
+                    print("Failed:{}:{}".format(futures[future], e))
+        return stored
+
+    def iter_search(
+            self, keyword, category="illustrations", order="date_d", mode="all", s_mode="s_tag", type_=None,
+            since_id: int = 0, max_pages: int = None, prefetch: int = 4, state: dict = None):
+        """Iterate search results page by page, following pages are fetched in parallel
+
+        Args:
+            category: "artworks", "illustrations", "manga"
+            order, mode, s_mode, type_: see get_search_*, type_ None means default of the category
+            since_id: Stop at the first illust with id <= since_id, only works for order "date_d"
+            max_pages: Max number of pages, None means all
+            prefetch: Max number of pages fetched ahead
+            state: A dict to receive "total" of results, "complete", which is True if all results
+                newer than since_id were listed, without errors or being limited by max_pages,
+                and "failed", which is True if listing stopped at a failed request
+
+        Yields:
+            list: illust data of a page in search result, excluding ads
+        """
+        if category not in self.search_categories:
+            raise ValueError("Incorrect category value: {}".format(category))
+        method_name, key = self.search_categories[category]
+        method = getattr(self.browser, method_name)
+        state = {} if state is None else state
+        state["complete"] = False
+        state["failed"] = False
+
+        def get_page(p):
+            if type_:
+                return method(keyword, order, mode, p, s_mode, type_)
+            return method(keyword, order, mode, p, s_mode)
+
+        body = get_page(1)
+        if not body:
+            state["failed"] = True
+            return
+        total = body.get(key).get("total")
+        state["total"] = total
+        result_pages = max(1, -(-total // self.search_page_size))
+        last_page = min(result_pages, max_pages) if max_pages else result_pages
+
+        # when results are newest first, estimate new pages by growth of total since last time
+        if since_id and order == "date_d":
+            _, last_total = self.db.get_search_watermark(keyword, category, mode, s_mode)
+            if last_total:
+                prefetch = min(prefetch, max(1, -(-(total - last_total) // self.search_page_size)))
+
+        with ThreadPoolExecutor(max(1, prefetch)) as executor:
+            pending = {}
+            next_p = 2
+            p = 1
+            while body:
+                illusts = [e for e in body.get(key).get("data") if e.get("id")]
+                if since_id and order == "date_d":
+                    new_illusts = [e for e in illusts if int(e.get("id")) > since_id]
+                    if len(new_illusts) < len(illusts):
+                        yield new_illusts
+                        state["complete"] = True
+                        break
+                yield illusts
+
+                if p >= last_page:
+                    state["complete"] = p >= result_pages
+                    break
+                while next_p <= last_page and len(pending) < prefetch:
+                    pending[next_p] = executor.submit(contextvars.copy_context().run, get_page, next_p)
+                    next_p += 1
+                p += 1
+                body = pending.pop(p).result()
+            else:
+                # an empty page means request failed
+                state["failed"] = True
+                for future in pending.values():
+                    future.cancel()
+                return
+            for future in pending.values():
+                future.cancel()
 
     # Crawl methods begin here
     # Used to automatic crawl metadata
     # by user followings or pixiv recommends
 
+    @pyxivtrace.traced()
     def _get_user_id_by_followings(self, user_id) -> list:
         """Return: [int(id), ...]"""
+        user_followings = self.db.get_edges("user_following", user_id, self.edge_max_age)
+        if user_followings is not None:
+            return user_followings
+
         # be sure all followings are retrieved
         user_followings = []
         i = 0
@@ -313,19 +562,51 @@ class PyxivSpider:
             # try to gey next 50 followings
             i += 50
             user_following = self.browser.get_user_following(user_id, i)  # next followings
+        user_followings = list(map(int, user_followings))
+        # an empty return means request failed, don't cache partial or empty lists, which may be errors
+        if user_following and user_followings:
+            self.db.insert_edges("user_following", user_id, user_followings).result()
         return user_followings
 
+    @pyxivtrace.traced()
     def _get_user_id_by_recommends(self, user_id) -> list:
         """Return: [int(id), ...]"""
+        user_recommends = self.db.get_edges("user_recommend", user_id, self.edge_max_age)
+        if user_recommends is not None:
+            return user_recommends
+
         # retrieve 100 recommends
         user_recommends = self.browser.get_user_recommends(user_id)
         if user_recommends:
-            user_recommends = [user.get("userId") for user in user_recommends.get("users")]
+            user_recommends = [int(user.get("userId")) for user in user_recommends.get("users")]
         else:
             user_recommends = []
+        if user_recommends:
+            self.db.insert_edges("user_recommend", user_id, user_recommends).result()
         return user_recommends
 
-    def _crawl_by_user(self, f_expand, seed_user_ids: set, max_user_num: int):
+    @pyxivtrace.traced()
+    def _get_illust_id_by_recommends(self, illust_id) -> list:
+        """Return: [int(id), ...]"""
+        illust_recommends = self.db.get_edges("illust_recommend", illust_id, self.edge_max_age)
+        if illust_recommends is not None:
+            return illust_recommends
+
+        illust_recommend_init = self.browser.get_illust_recommend_init(illust_id)
+        if illust_recommend_init:
+            # first page is illusts, and nextIds are ids of following pages,
+            # details covers both, but is only used for ids not in pages
+            page_ids = [illust.get("id") for illust in illust_recommend_init.get("illusts") if illust.get("id")]
+            page_ids.extend(illust_recommend_init.get("nextIds") or [])
+            page_ids.extend(illust_recommend_init.get("details") or [])  # actually a dict or empty list
+            illust_recommends = list(dict.fromkeys(map(int, page_ids)))
+        else:
+            illust_recommends = []
+        if illust_recommends:
+            self.db.insert_edges("illust_recommend", illust_id, illust_recommends).result()
+        return illust_recommends
+
+    def _crawl_by_user(self, f_expand, seed_user_ids: set, max_user_num: int, seed_strategy="bookmark", kind="user_following"):
         """Crawl by f_expand
 
         Args:
@@ -333,21 +614,22 @@ class PyxivSpider:
             seed_user_ids: A set of int or None, if not a empty set, the spider use it as primary seeds,
             if None, it will use user ids exist in database for seeds.
             max_user_num: The max user num of crawling in one time
+            seed_strategy: strategy of PyxivSeedSampler to choose seeds from database
+            kind: kind of edges f_expand returns, "user_following" or "user_recommend"
 
         Note:
             The max_user_num will exclude all existing user in database.
         """
 
         # get exist user ids
-        exist_user_ids = list(row[0] for row in self.db("SELECT DISTINCT user_id FROM illust ORDER BY bookmark_count DESC;"))
+        if self.id_index:
+            exist_user_ids = self.id_index.user_ids()
+        else:
+            exist_user_ids = list(row[0] for row in self.db("SELECT DISTINCT user_id FROM illust;"))
 
         # prepare seeds
         if seed_user_ids is None:
-            seed_user_ids = exist_user_ids[: 1000].copy()
-            # be sure to random choose seed user from database
-            for _ in range(10000):
-                random.shuffle(seed_user_ids)
-            seed_user_ids = seed_user_ids[: 10]  # use 10 for seeds
+            seed_user_ids = self.seeds.sample_user_ids(10, seed_strategy, 1000, kind)  # use 10 for seeds
 
         # BFS crawl critierion
         # queue: seed_user_ids: [id, ...]
@@ -376,56 +658,58 @@ class PyxivSpider:
                 else:
                     seed_user_ids.add(user_id)  # not remove it
 
-    def crawl_by_user_followings(self, seed_user_ids: set = None, max_user_num: int = 300):
+    def crawl_by_user_followings(self, seed_user_ids: set = None, max_user_num: int = 300, seed_strategy="bookmark"):
         """Crawl by followings
 
         Args:
             seed_user_ids: A set of int or None, if a set, the spider will iterate all user and get its followings,
             if None, it will use random 10 user ids exist in database for seeds.
             max_user_num: The max user num of crawling in one time
+            seed_strategy: "bookmark", "stale", "newest", "rare_tag", see PyxivSeedSampler
 
         Note:
             The max_user_num will exclude all existing user in database.
         """
 
-        return self._crawl_by_user(self._get_user_id_by_followings, seed_user_ids, max_user_num)
+        return self._crawl_by_user(self._get_user_id_by_followings, seed_user_ids, max_user_num, seed_strategy, "user_following")
 
-    def crawl_by_user_recommends(self, seed_user_ids: set = None, max_user_num: int = 300):
+    def crawl_by_user_recommends(self, seed_user_ids: set = None, max_user_num: int = 300, seed_strategy="bookmark"):
         """Crawl by recommends
 
         Args:
             seed_user_ids: A set of int or None, if a set, the spider will iterate all user and get its recommends,
             if None, it will use random 10 user ids exist in database for seeds.
             max_user_num: The max user num of crawling in one time
+            seed_strategy: "bookmark", "stale", "newest", "rare_tag", see PyxivSeedSampler
 
         Note:
             The max_user_num will exclude all existing user in database.
         """
 
-        return self._crawl_by_user(self._get_user_id_by_recommends, seed_user_ids, max_user_num)
+        return self._crawl_by_user(self._get_user_id_by_recommends, seed_user_ids, max_user_num, seed_strategy, "user_recommend")
 
-    def crawl_by_illust_recommends(self, seed_illust_ids: set = None, max_illust_num: int = 30000):
+    def crawl_by_illust_recommends(self, seed_illust_ids: set = None, max_illust_num: int = 30000, seed_strategy="bookmark"):
         """Crawl by illust recommends
 
         Args:
             seed_illust_ids: A set of int or None, if not a empty set, the spider use it as primary seeds,
             if None, it will use illust ids exist in database for seeds.
             max_illust_num: The max user num of crawling in one time
+            seed_strategy: "bookmark", "stale", "newest", "rare_tag", see PyxivSeedSampler
 
         Note:
             The max_illust_num will exclude all existing illust in database.
         """
 
         # get exist user ids
-        exist_illust_ids = list(row[0] for row in self.db("SELECT id FROM illust ORDER BY bookmark_count DESC;"))
+        if self.id_index:
+            exist_illust_ids = self.id_index.illust_ids()
+        else:
+            exist_illust_ids = list(row[0] for row in self.db("SELECT id FROM illust;"))
 
         # prepare seeds
         if seed_illust_ids is None:
-            seed_illust_ids = exist_illust_ids[: 10000].copy()
-            # be sure to random choose seed user from database
-            for _ in range(100000):
-                random.shuffle(seed_illust_ids)
-            seed_illust_ids = seed_illust_ids[: 100]  # use 100 for seeds
+            seed_illust_ids = self.seeds.sample_illust_ids(100, seed_strategy, 10000)  # use 100 for seeds
 
         # BFS crawl critierion
         # queue: seed_illust_ids: [id, ...]
@@ -441,13 +725,11 @@ class PyxivSpider:
             # add new_user_ids to seed_illust_ids
             # and limit the length of seed_illust_ids
             if len(seed_illust_ids) < 1000000:
-                illust_recommend_init = self.browser.get_illust_recommend_init(illust_id)
-                if illust_recommend_init:
-                    seed_illust_ids.update(
-                        set(map(int, illust_recommend_init.get("details")))  # actually a dict or empty list # be sure int id
-                        .difference(exist_illust_ids)
-                        .difference(saved_illust_ids)
-                    )
+                seed_illust_ids.update(
+                    set(self._get_illust_id_by_recommends(illust_id))
+                    .difference(exist_illust_ids)
+                    .difference(saved_illust_ids)
+                )
 
             # check if save current illust_id
             if not (illust_id in exist_illust_ids or illust_id in saved_illust_ids):
@@ -461,60 +743,246 @@ class PyxivSpider:
     # It will first search database for illust information
     # If not found, save_illust will be called before downloading the illust
 
+    @pyxivtrace.traced()
     @wrapper.log_calling_info()
-    def download_page(self, page_url, save_dir) -> bool:
-        """Download a page to save_dir"""
+    def download_page(self, page_url, save_dir, max_bytes: int = None) -> bool:
+        """Download a page to save_dir
+
+        Args:
+            max_bytes: Byte budget of the page, the page won't be downloaded if it is larger, None means no limit
+        """
         os.makedirs(save_dir, exist_ok=True)
         file_name = page_url.split("/")[-1]
         if file_name in os.listdir(save_dir):
             return True
         else:
+            if max_bytes and self.browser.get_page_size(page_url) > max_bytes:
+                return False
             content = self.browser.get_page(page_url)
-            if content:
-                with open(Path(save_dir, file_name), "wb") as f:
-                    f.write(content)
+            if content and not (max_bytes and len(content) > max_bytes):
+                with pyxivtrace.span("file_write", bytes=len(content)):
+                    with open(Path(save_dir, file_name), "wb") as f:
+                        f.write(content)
                 return True
             else:
                 return False
 
-    def download_illust(self, illust_id, save_dir) -> bool:
+    def _check_size(self, size):
+        if size not in self.page_sizes:
+            raise ValueError("Incorrect size value: {}".format(size))
+
+    def _check_max_distance(self, max_distance):
+        # without Pillow no page is hashed, so similar pages would be downloaded silently
+        if max_distance is not None and not Image:
+            raise ImportError("max_distance requires Pillow, install it by: pip install Pillow")
+
+    @pyxivtrace.traced()
+    def _resolve_illust(self, illust_id) -> dict:
+        """Get cached row of an illust, save it to database first if missing
+
+        Returns:
+            dict: row of PyxivIllustCache, None if failed to save
+        """
+        illust = self.illusts.get(illust_id)
+        if not illust and self.save_illust(illust_id):
+            illust = self.illusts.get(illust_id)
+        return illust
+
+    def _page_hash(self, illust_id, page_id, thumb_url) -> int:
+        """Perceptual hash of a page from its thumbnail, stored in page_hash
+
+        Returns:
+            int: hash, None if failed or Pillow is not installed
+        """
+        row = self.db("SELECT hash FROM page_hash WHERE illust_id = ? AND page_id = ?;", (illust_id, page_id))
+        if row:
+            return row[0][0] & 0xFFFFFFFFFFFFFFFF
+        content = self.browser.get_page(thumb_url) if thumb_url else b""
+        if not content:
+            return None
+        try:
+            hash_ = dhash(content)
+        except Exception as e:
+            self.logger.error("Spider:Failed to hash:{}:{}".format(thumb_url, e))
+            return None
+        if hash_ is not None:
+            self.db.insert_page_hash(illust_id, page_id, hash_).result()
+        return hash_
+
+    def _refresh_page_urls(self, illust: dict) -> dict:
+        """Fetch and store urls of all sizes of pages of a row of PyxivIllustCache
+
+        Returns:
+            dict: the row with new urls, or the row unchanged if failed
+        """
+        pages = self.browser.get_illust_pages(illust["id"])
+        if not pages:
+            return illust
+        pages = [tuple(page.get("urls").get(size) or "" for size in self.page_sizes) for page in pages]
+        futures = [self.db.insert_page(illust["id"], page_id, *urls) for page_id, urls in enumerate(pages)]
+        for future in futures:
+            future.result()
+        self.illusts.invalidate(illust["id"])
+        return {**illust, "pages": pages}
+
+    def _download_illust_pages(self, illust: dict, save_dir, size, fallback, max_bytes, max_distance: int = None) -> bool:
+        """Download pages of a row of PyxivIllustCache
+
+        Urls of pages are fetched again once if any page lacks urls of the size, as pages stored before
+        size variants only have original url.
+
+        Args:
+            max_distance: Skip pages whose perceptual hash is within max_distance of a downloaded page, None for no skip
+
+        Returns:
+            bool: True if all pages were downloaded or skipped as similar, else False
+        """
+        if illust["x_restrict"] > 0:
+            save_dir = Path(save_dir, "R-18")
+
+        sizes = self.page_sizes[self.page_sizes.index(size):] if fallback else [size]
+        indexes = [self.page_sizes.index(size_) for size_ in sizes]
+        if any(
+            not any(page[i] for i in indexes) or (max_distance is not None and not page[self.page_sizes.index("thumb_mini")])
+            for page in illust["pages"]
+        ):
+            illust = self._refresh_page_urls(illust)
+        result = True
+        for page_id, page in enumerate(illust["pages"]):
+            page_urls = dict(zip(self.page_sizes, page))
+            hash_ = None
+            if max_distance is not None:
+                hash_ = self._page_hash(illust["id"], page_id, page_urls["thumb_mini"])
+                similar = self.db.find_similar_pages(hash_, max_distance, illust["id"]) if hash_ is not None else []
+                if similar:
+                    print("Skip similar page:{}_p{}:{}".format(illust["id"], page_id, similar[0]))
+                    continue
+            if not any(page_urls[size_] for size_ in sizes):
+                self.logger.warning("Spider:No {} url of page {}_p{}, use fallback for other sizes".format(
+                    size, illust["id"], page_id
+                ))
+                result = False
+                continue
+            for size_ in sizes:
+                if not page_urls[size_]:
+                    continue
+                page_dir = save_dir if size_ == "original" else Path(save_dir, size_)
+                page_path = Path(page_dir, page_urls[size_].split("/")[-1])
+                exists = page_path.exists()
+                if self.download_page(page_urls[size_], page_dir, max_bytes):
+                    # only process newly written files
+                    if self.processor and not exists:
+                        self.processor.submit(illust["id"], page_id, size_, page_path)
+                    if hash_ is not None:
+                        self.db.set_page_downloaded(illust["id"], page_id)
+                    break
+            else:
+                result = False
+        return result
+
+    def _download_pipeline(
+            self, illust_ids, save_dir, size, fallback, max_bytes, max_distance: int = None, workers: int = None,
+            post=None, list_=None) -> list:
+        """List illusts, resolve metadata, download pages and run post actions of illusts in a pipeline
+
+        Args:
+            illust_ids: An iterable of illust ids, or of inputs of list_
+            workers: number of workers of resolve and download stages, default to pipeline_workers of config
+            post: callable, [param: row of PyxivIllustCache | return: None], run after the illust downloaded
+            list_: callable, [param: an item of illust_ids | return: iterable of illust ids], run as the first stage,
+                can be a generator which lists ids lazily
+
+        Returns:
+            list: rows of PyxivIllustCache of illusts downloaded, with all pages downloaded
+        """
+        stage_workers = {
+            "resolve": self.browser.rate_controller.max_concurrency,
+            "download": self.browser.rate_controller.max_concurrency,
+            "post": 1,
+            **(self.config.pipeline_workers or {})
+        }
+        if workers:
+            stage_workers.update(resolve=workers, download=workers)
+
+        def download(illust):
+            if not self._download_illust_pages(illust, save_dir, size, fallback, max_bytes, max_distance):
+                raise RuntimeError("Failed to download some pages of illust {}".format(illust["id"]))
+            return illust
+
+        def post_action(illust):
+            post(illust)
+            return illust
+
+        pipeline = PyxivPipeline()
+        if list_:
+            pipeline.add_stage("list", list_, 1, expand=True)
+        pipeline.add_stage("resolve", self._resolve_illust, stage_workers["resolve"])
+        pipeline.add_stage("download", download, stage_workers["download"])
+        if post:
+            pipeline.add_stage("post", post_action, stage_workers["post"])
+        illusts = pipeline.run(illust_ids)
+        print(pipeline.report())
+        if self.processor:
+            self.processor.submit_pending()
+            self.processor.wait()
+            print("Post-processed: {processed}, pending: {skipped}, errors: {errors}".format(**self.processor.counts))
+        return illusts
+
+    def download_illust(
+            self, illust_id, save_dir, size="original", fallback: bool = False, max_bytes: int = None,
+            max_distance: int = None) -> bool:
         """Save all pages of an illust
 
+        Args:
+            size: "original", "regular", "small", "thumb_mini", pages of size other than "original" are saved to a sub dir named by size
+            fallback: whether try smaller sizes when a page failed to download or exceeded max_bytes
+            max_bytes: Byte budget of each page, None means no limit
+            max_distance: Skip pages whose thumbnail is similar to a downloaded page of another illust,
+                within this Hamming distance of 64 bit perceptual hashes, e.g. 4. None means no skip, needs Pillow
+
         Returns:
             bool: Return True if the illust information is stored in database, else False
         """
+        self._check_size(size)
+        self._check_max_distance(max_distance)
 
         # try to retrieve illust information in database or save it
-        if not self.db("SELECT id FROM illust WHERE id = ?;", (illust_id, )):
-            if not self.save_illust(illust_id):
-                return False
-        page_urls = [row[0] for row in self.db("SELECT url_original FROM page WHERE illust_id = ?;", (illust_id, ))]
-        x_restrict, *_ = self.db("SELECT x_restrict FROM illust WHERE id = ?", (illust_id,))[0]
-        if x_restrict > 0:
-            save_dir = Path(save_dir, "R-18")
-        for page_url in page_urls:
-            self.download_page(page_url, save_dir)
+        illust = self._resolve_illust(illust_id)
+        if not illust:
+            return False
+        self._download_illust_pages(illust, save_dir, size, fallback, max_bytes, max_distance)
         return True
 
-    def download_user(self, user_id, save_dir) -> bool:
+    def download_user(
+            self, user_id, save_dir, size="original", fallback: bool = False, max_bytes: int = None,
+            max_distance: int = None, workers: int = None) -> bool:
         """Save all illust of a user
 
+        Args:
+            size, fallback, max_bytes, max_distance: see download_illust
+            workers: number of workers of each pipeline stage, default to pipeline_workers of config
+
         Returns:
-            bool: Return True if the user information has been stored in database, else False
+            bool: Return True if any illust of the user has been stored in database, else False
         """
+        self._check_size(size)
+        self._check_max_distance(max_distance)
 
-        # fisrt save_user
-        if self.save_user(user_id):
-            user_name = self.db("SELECT name FROM user WHERE id = ?;", (user_id,))[0][0]
-            illust_ids = [row[0] for row in self.db("SELECT id FROM illust WHERE user_id = ?;", (user_id,))]
-            save_dir = Path(save_dir, "{}_{}".format(user_id, user_name))
-            for illust_id in illust_ids:
-                self.download_illust(illust_id, save_dir)
-            return True
-        else:
+        user_all = self.browser.get_user_profile_all(user_id)
+        if not user_all:
             return False
-
-    def download_ranking(self, save_dir, p=1, content="illust", mode="monthly", date=None):
+        illust_ids = list(map(int, user_all.get("illusts")))
+        user_name = self.db("SELECT name FROM user WHERE id = ?;", (user_id,))
+        user_name = user_name[0][0] if user_name else self.browser.get_user(user_id).get("name", "")
+        save_dir = Path(save_dir, "{}_{}".format(user_id, user_name))
+
+        # warm up cache of existing illusts in batch
+        self.illusts.get_many(illust_ids)
+        return len(self._download_pipeline(illust_ids, save_dir, size, fallback, max_bytes, max_distance, workers)) > 0
+
+    def download_ranking(
+            self, save_dir, p=1, content="illust", mode="monthly", date=None,
+            size="original", fallback: bool = False, max_bytes: int = None, max_distance: int = None, workers: int = None):
         """Get ranking, limit 50 illusts info in one page
 
         Args:
@@ -527,20 +995,75 @@ class PyxivSpider:
             mode: ["daily", "weekly", "daily_r18", "weekly_r18", "monthly", "rookie",
                 "original", "male", "male_r18", "female", "female_r18"]
             date: ranking date, example: 20210319, None means the newest
+            size, fallback, max_bytes, max_distance: see download_illust
+            workers: number of workers of each pipeline stage, default to pipeline_workers of config
 
         Note: May need cookies to get r18 ranking
         """
+        self._check_size(size)
+        self._check_max_distance(max_distance)
         ranking = self.browser.get_ranking(p, content, mode, date)
         if ranking:
             save_dir = Path(save_dir, "ranking_{}".format(ranking.get("date")))
             illust_ids = [e.get("illust_id") for e in ranking.get("contents")]
-            for illust_id in illust_ids:
-                self.download_illust(illust_id, save_dir)
+            self.illusts.get_many(illust_ids)
+            self._download_pipeline(illust_ids, save_dir, size, fallback, max_bytes, max_distance, workers)
+
+    def download_search_illustrations(
+            self, keyword, save_dir, category="illustrations", mode="all", s_mode="s_tag", type_=None,
+            incremental: bool = True, max_pages: int = None,
+            size="original", fallback: bool = False, max_bytes: int = None, max_distance: int = None,
+            workers: int = None) -> int:
+        """Download search results newest first, pages of results are listed while illusts are downloading
 
-    def download_search_illustrations(self, save_dir):
-        raise NotImplementedError
+        Args:
+            category, mode, s_mode, type_: see iter_search
+            incremental: Only download illusts newer than the newest one of last incremental search of the same arguments,
+                and illusts of earlier incremental searches failed to download, see PyxivDatabase.search_retry_max_attempts
+            max_pages: Max number of result pages
+            size, fallback, max_bytes, max_distance: see download_illust
+            workers: number of workers of each pipeline stage, default to pipeline_workers of config
+
+        Returns:
+            int: Number of illusts downloaded
+        """
+        self._check_size(size)
+        self._check_max_distance(max_distance)
+        since_id = self.db.get_search_watermark(keyword, category, mode, s_mode)[0] if incremental else 0
+        retry_ids = set(self.db.get_search_retries(keyword, category, mode, s_mode) if incremental else [])
+        state = {}
+        listed_ids = set()
+
+        def list_illust_ids(keyword):
+            self.illusts.get_many(retry_ids)
+            yield from retry_ids
+            for illusts in self.iter_search(keyword, category, "date_d", mode, s_mode, type_, since_id, max_pages, state=state):
+                illust_ids = [int(e.get("id")) for e in illusts]
+                listed_ids.update(illust_ids)
+                self.illusts.get_many(illust_ids)
+                yield from (illust_id for illust_id in illust_ids if illust_id not in retry_ids)
+            if state.get("failed"):
+                raise RuntimeError("Failed to list search results of {}".format(keyword))
+
+        illusts = self._download_pipeline(
+            [keyword], Path(save_dir, "search_{}".format(keyword)), size, fallback, max_bytes, max_distance, workers,
+            list_=list_illust_ids
+        )
 
-    def download_illusts(self, illust_ids, save_dir, bookmark_illusts: bool = False, bookmark_users: bool = False):
+        # illusts failed to resolve or download are retried by later searches, a few times,
+        # and watermark only moves when all new results were listed
+        if incremental:
+            attempted_ids = listed_ids.union(retry_ids)
+            done_ids = attempted_ids.intersection(illust["id"] for illust in illusts)
+            self.db.update_search_retries(keyword, category, mode, s_mode, attempted_ids.difference(done_ids), done_ids).result()
+            if state.get("complete"):
+                max_id = max(listed_ids, default=since_id)
+                self.db.insert_search_watermark(keyword, category, mode, s_mode, max_id, state.get("total")).result()
+        return len(illusts)
+
+    def download_illusts(
+            self, illust_ids, save_dir, bookmark_illusts: bool = False, bookmark_users: bool = False,
+            size="original", fallback: bool = False, max_bytes: int = None, max_distance: int = None, workers: int = None):
         """Download illusts, aimed to fit indexer
 
         Args:
@@ -548,24 +1071,26 @@ class PyxivSpider:
             save_dir: save dir
             bookmark_illusts: whether add bookmarks to all illusts downloaded
             bookmark_users: whether add bookmarks to all users of illusts downloaded
+            size, fallback, max_bytes, max_distance: see download_illust
+            workers: number of workers of each pipeline stage, default to pipeline_workers of config
         """
-        success_ids = []
-        for illust_id in illust_ids:
-            if self.download_illust(illust_id, save_dir):
-                success_ids.append(illust_id)
-
-        illusts_info = []
-        for illust_id in success_ids:
-            illusts_info.extend(self.db("SELECT id, user_id FROM illust WHERE id = ?;", (illust_id,)))
-        if bookmark_illusts:
-            for illust_id, _ in illusts_info:
-                self.browser.post_illusts_bookmarks_add(illust_id)
-        if bookmark_users:
-            for _, user_id in illusts_info:
-                self.browser.post_bookmark_add(user_id)
+        self._check_size(size)
+        self._check_max_distance(max_distance)
+
+        def bookmark(illust):
+            if bookmark_illusts:
+                self.browser.post_illusts_bookmarks_add(illust["id"])
+            if bookmark_users:
+                self.browser.post_bookmark_add(illust["user_id"])
+
+        self.illusts.get_many(illust_ids)
+        illusts = self._download_pipeline(
+            illust_ids, save_dir, size, fallback, max_bytes, max_distance, workers,
+            bookmark if bookmark_illusts or bookmark_users else None
+        )
 
         print("Total: {}".format(len(illust_ids)))
-        print("Success: {}".format(len(success_ids)))
+        print("Success: {}".format(len(illusts)))
 
 
 if __name__ == "__main__":
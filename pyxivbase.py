@@ -1,13 +1,36 @@
+import atexit
+import base64
+import bisect
+import contextvars
+import gzip
+import hashlib
+import heapq
 import json
 import logging
+import os
+import queue
 import random
+import re
 import sqlite3
+import threading
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from datetime import datetime, timedelta, timezone
-from time import sleep
+from pathlib import Path
+from time import sleep, time
+from urllib.parse import urlparse
 
 import bs4
 import requests
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import pyxivtrace
 import wrapper
 
 
@@ -21,6 +44,14 @@ class PyxivConfig:
         return self.__config.get(name)
 
 
+class _ThreadReader:
+    """Read-only connection of a thread, held by thread local storage"""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.shard_version = -1
+
+
 class PyxivDatabase:
     """PyxivDatabase
 
@@ -48,26 +79,262 @@ class PyxivDatabase:
             "illust_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
             "page_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
             "url_original" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
+            "url_regular" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
+            "url_small" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
+            "url_thumb_mini" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
             PRIMARY KEY ("illust_id", "page_id") ON CONFLICT REPLACE,
             FOREIGN KEY ("illust_id") REFERENCES "illust" ("id") ON DELETE CASCADE ON UPDATE CASCADE
         );
-        CREATE TABLE "tag" (
-            "name" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
+        CREATE TABLE "tag_name" (
+            "id" INTEGER NOT NULL,
+            "name" TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+            PRIMARY KEY ("id"),
+            UNIQUE ("name") ON CONFLICT IGNORE
+        );
+        CREATE TABLE "illust_tag" (
+            "tag_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
             "illust_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
-            PRIMARY KEY ("name", "illust_id") ON CONFLICT REPLACE,
+            PRIMARY KEY ("tag_id", "illust_id") ON CONFLICT IGNORE,
+            FOREIGN KEY ("tag_id") REFERENCES "tag_name" ("id") ON DELETE CASCADE ON UPDATE CASCADE,
             FOREIGN KEY ("illust_id") REFERENCES "illust" ("id") ON DELETE CASCADE ON UPDATE CASCADE
         );
+        CREATE INDEX "illust_tag_illust_id" ON "illust_tag" ("illust_id", "tag_id");
+        CREATE VIEW "tag" AS SELECT ...;  -- (name, illust_id) rows, read only
+        CREATE TABLE "illust_stats" (
+            "illust_id" INTEGER NOT NULL,
+            "epoch" INTEGER NOT NULL,
+            "bookmark_count" INTEGER NOT NULL DEFAULT 0,
+            "like_count" INTEGER NOT NULL DEFAULT 0,
+            "view_count" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("illust_id", "epoch") ON CONFLICT REPLACE
+        ) WITHOUT ROWID;
+        CREATE TABLE "illust_trending" (
+            "illust_id" INTEGER NOT NULL,
+            "score" REAL NOT NULL DEFAULT 0,
+            "epoch" INTEGER NOT NULL DEFAULT 0,
+            "bookmark_count" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("illust_id") ON CONFLICT REPLACE
+        );
+        CREATE INDEX "illust_trending_score" ON "illust_trending" ("score");
+        CREATE TABLE "meta" (
+            "key" TEXT NOT NULL,
+            "value" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("key") ON CONFLICT REPLACE
+        );
+        CREATE TABLE "search_result" (
+            "key" TEXT NOT NULL,
+            "generation" INTEGER NOT NULL DEFAULT 0,
+            "result" TEXT NOT NULL DEFAULT '[]',
+            PRIMARY KEY ("key") ON CONFLICT REPLACE
+        );
+        CREATE TABLE "edge" (
+            "kind" INTEGER NOT NULL,
+            "src" INTEGER NOT NULL,
+            "dst" INTEGER NOT NULL,
+            "rank" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("kind", "src", "dst") ON CONFLICT IGNORE
+        ) WITHOUT ROWID;
+        CREATE INDEX "edge_dst" ON "edge" ("kind", "dst");
+        CREATE TABLE "edge_fetch" (
+            "kind" INTEGER NOT NULL,
+            "src" INTEGER NOT NULL,
+            "epoch" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("kind", "src") ON CONFLICT REPLACE
+        ) WITHOUT ROWID;
+        CREATE INDEX "edge_fetch_epoch" ON "edge_fetch" ("kind", "epoch");
+        CREATE INDEX "illust_bookmark_count" ON "illust" ("bookmark_count");
+        CREATE TABLE "ranking" (
+            "date" TEXT NOT NULL,
+            "mode" TEXT NOT NULL,
+            "content" TEXT NOT NULL,
+            "rank" INTEGER NOT NULL,
+            "illust_id" INTEGER NOT NULL,
+            "yes_rank" INTEGER NOT NULL DEFAULT 0,
+            "view_count" INTEGER NOT NULL DEFAULT 0,
+            "rating_count" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("date", "mode", "content", "rank") ON CONFLICT REPLACE
+        ) WITHOUT ROWID;
+        CREATE INDEX "ranking_illust_id" ON "ranking" ("illust_id");
+        CREATE TABLE "ranking_fetch" (
+            "date" TEXT NOT NULL,
+            "mode" TEXT NOT NULL,
+            "content" TEXT NOT NULL,
+            "rank_total" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("date", "mode", "content") ON CONFLICT REPLACE
+        ) WITHOUT ROWID;
+        CREATE TABLE "search_watermark" (
+            "keyword" TEXT NOT NULL,
+            "category" TEXT NOT NULL,
+            "mode" TEXT NOT NULL,
+            "s_mode" TEXT NOT NULL,
+            "max_illust_id" INTEGER NOT NULL DEFAULT 0,
+            "total" INTEGER NOT NULL DEFAULT 0,
+            "epoch" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("keyword", "category", "mode", "s_mode") ON CONFLICT REPLACE
+        ) WITHOUT ROWID;
+        CREATE TABLE "search_retry" (
+            "keyword" TEXT NOT NULL,
+            "category" TEXT NOT NULL,
+            "mode" TEXT NOT NULL,
+            "s_mode" TEXT NOT NULL,
+            "illust_id" INTEGER NOT NULL,
+            "attempts" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("keyword", "category", "mode", "s_mode", "illust_id") ON CONFLICT REPLACE
+        ) WITHOUT ROWID;
+        CREATE TABLE "user_sync" (
+            "user_id" INTEGER PRIMARY KEY ON CONFLICT REPLACE,
+            "synced_epoch" INTEGER NOT NULL,
+            "next_epoch" INTEGER NOT NULL,
+            "max_illust_id" INTEGER NOT NULL DEFAULT 0,
+            "illust_count" INTEGER NOT NULL DEFAULT 0,
+            "post_rate" REAL NOT NULL DEFAULT 0,
+            "interval" INTEGER NOT NULL
+        );
+        CREATE INDEX "user_sync_next_epoch" ON "user_sync" ("next_epoch");
+        CREATE TABLE "page_file" (
+            "illust_id" INTEGER NOT NULL,
+            "page_id" INTEGER NOT NULL,
+            "size" TEXT NOT NULL,
+            "path" TEXT NOT NULL,
+            "format" TEXT NOT NULL DEFAULT "",
+            "width" INTEGER NOT NULL DEFAULT 0,
+            "height" INTEGER NOT NULL DEFAULT 0,
+            "bytes" INTEGER NOT NULL DEFAULT 0,
+            "frames" INTEGER NOT NULL DEFAULT 1,
+            "thumb_path" TEXT NOT NULL DEFAULT "",
+            "attempts" INTEGER NOT NULL DEFAULT 0,
+            "error" TEXT NOT NULL DEFAULT "",
+            PRIMARY KEY ("illust_id", "page_id", "size") ON CONFLICT REPLACE
+        ) WITHOUT ROWID;
+        CREATE TABLE "page_hash" (
+            "illust_id" INTEGER NOT NULL,
+            "page_id" INTEGER NOT NULL,
+            "hash" INTEGER NOT NULL,
+            "c0" INTEGER NOT NULL,
+            "c1" INTEGER NOT NULL,
+            "c2" INTEGER NOT NULL,
+            "c3" INTEGER NOT NULL,
+            "downloaded" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("illust_id", "page_id") ON CONFLICT REPLACE
+        ) WITHOUT ROWID;
+        CREATE INDEX "page_hash_c0" ON "page_hash" ("c0");  -- and c1, c2, c3
+        CREATE TABLE "shard" (
+            "name" TEXT NOT NULL,
+            "path" TEXT NOT NULL DEFAULT '',
+            "low" INTEGER NOT NULL,
+            PRIMARY KEY ("name")
+        );
+        CREATE TABLE "job" (
+            "id" INTEGER NOT NULL,
+            "method" TEXT NOT NULL,
+            "args" TEXT NOT NULL DEFAULT '[]',
+            "kwargs" TEXT NOT NULL DEFAULT '{}',
+            "kind" TEXT NOT NULL,
+            "priority" INTEGER NOT NULL DEFAULT 0,
+            "state" TEXT NOT NULL DEFAULT 'queued',  -- queued, running, done, failed, cancelled
+            "created" INTEGER NOT NULL,
+            "started" INTEGER NOT NULL DEFAULT 0,
+            "finished" INTEGER NOT NULL DEFAULT 0,
+            "result" TEXT NOT NULL DEFAULT '',
+            "error" TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY ("id")
+        );
+        CREATE INDEX "job_state" ON "job" ("state", "priority", "id");
 
     Methods:
-        insert_*: insert or update row
+        insert_*: insert or update row, insert_* of user, illust, page and tag increase generation of database
+
+    Threading:
+        Reads use one read-only connection per thread, all writes are executed by a single writer thread,
+        which takes calls from a bounded queue and commits them in batches.
+        insert_* return a concurrent.futures.Future, which is done after the row is committed,
+        and raises the sqlite3.Error of the call, if any.
+
+    Note:
+        illust_stats is append only, one row for each refresh of an illust.
+        illust_trending.score is bookmarks gained per day, smoothed by an exponential moving average
+        with half life trending_half_life, and is updated on each insert_illust.
+        edge stores expansion results of crawling, kind is a value of edge_kinds,
+        and edge_fetch records when the edges of a src were fetched.
+        search_retry holds illusts of incremental searches failed to download, below the watermark,
+        they are retried by later searches until they failed search_retry_max_attempts times.
+        user_sync.post_rate is new illusts per day of a user, smoothed over syncs, and the user is due
+        to sync again after interval seconds, about the time to post one illust, within sync_interval_range.
+        page_file rows with bytes 0 are pages waiting to be post-processed by PyxivImageProcessor,
+        attempts is the number of failed processing of the page, and error is the last error.
+        page_hash is a multi-index of 64 bit perceptual hashes, split into four 16 bit chunks c0-c3,
+        hashes within distance d share a chunk within distance d // 4, so lookups only probe indexes of chunks.
+
+    Sharding:
+        Rows of sharded_tables are stored in shards by illust id range, a shard holds ids from its low
+        to low of the next shard. "main" is the first shard, others are files attached to each connection.
+        With more than one shard, each connection has TEMP VIEWs of the same names, which union all shards,
+        each filtered by its range, so SELECT queries see all rows unchanged, while insert_* write to the shard of each illust id.
+        A shard with more than shard_max_illusts illusts is split in half into a new file by the writer thread,
+        rows moved out of the old shard are deleted after readers have switched to the new views.
+        Paths of shard files are relative to the dir of the main database, so they can be moved together.
+        Only connections of this PyxivDatabase see new shards, other processes should reopen the database.
     """
 
-    def __init__(self, db_path):
-        self.connection = sqlite3.connect(db_path, isolation_level=None)
-        self._init()
+    # kind of edge -> (kind value, table and column of dst)
+    edge_kinds = {
+        "illust_recommend": (0, "illust", "id"),
+        "user_following": (1, "user", "id"),
+        "user_recommend": (2, "user", "id"),
+    }
+
+    trending_half_life = 7 * 86400  # seconds
+
+    sync_interval_range = (86400, 90 * 86400)  # seconds, min and max interval between syncs of a user
+
+    search_retry_max_attempts = 3
+
+    # sharded table -> column of illust id
+    sharded_tables = {"illust": "id", "page": "illust_id", "illust_tag": "illust_id"}
+
+    # columns of tables for export and import, "tag" is the (name, illust_id) view
+    dump_columns = {
+        "user": ["id", "name"],
+        "illust": [
+            "id", "title", "description", "bookmark_count", "like_count", "view_count",
+            "user_id", "x_restrict", "upload_date", "last_update_date"
+        ],
+        "page": ["illust_id", "page_id", "url_original", "url_regular", "url_small", "url_thumb_mini"],
+        "tag": ["name", "illust_id"],
+    }
+
+    def __init__(self, db_path, queue_size: int = 1024, batch_size: int = 256, shard_max_illusts: int = None):
+        """
+        Args:
+            queue_size: Max number of pending writes, insert_* block when the queue is full
+            batch_size: Max number of writes committed in one transaction
+            shard_max_illusts: Split a shard when it has more illusts, None for no splitting
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.shard_max_illusts = shard_max_illusts
+        self._shards = [(0, "main", "")]  # (low, name, path) sorted by low, replaced by writer thread
+        self._shard_version = 0
+        self._split_requested = False
+        self.logger = logging.getLogger(__name__)
+        # tag name -> tag_name.id, only used in writer thread, new ids are published to _tag_ids after commit
+        self._tag_ids = {}
+        self._batch_tag_ids = {}  # new ids of released calls in current batch
+        self._call_tag_ids = {}  # new ids of current call
+        self._local = threading.local()
+        self._readers = set()  # open reader connections, closed when their threads end
+        self._readers_lock = threading.Lock()
+
+        self._queue = queue.Queue(queue_size)
+        ready = Future()
+        self._writer = threading.Thread(target=self._write_loop, args=(ready,), name="PyxivDatabaseWriter", daemon=True)
+        self._writer.start()
+        ready.result()
+        atexit.register(self.close)
 
     def __del__(self):
-        self.connection.close()
+        if getattr(self, "_writer", None):
+            self.close()
 
     @wrapper.database_operation()
     def __call__(self, sql: str, parameters=None) -> list:
@@ -75,26 +342,289 @@ class PyxivDatabase:
 
         Returns:
             Always returns the fetchall() of a cursor object, return [] when no result
+
+        Note:
+            Statements other than SELECT are executed by the writer thread, and wait to be committed
         """
-        if parameters:
-            return self.connection.execute(sql, parameters).fetchall()
-        else:
-            return self.connection.execute(sql).fetchall()
+        if sql.lstrip().upper().startswith(("SELECT", "WITH", "EXPLAIN")):
+            with pyxivtrace.span("db_query"):
+                return self._reader().execute(sql, parameters or ()).fetchall()
+        return self._submit(lambda connection: connection.execute(sql, parameters or ()).fetchall()).result()
 
     def __len__(self):
-        return len(self.connection.execute("SELECT id FROM illust;").fetchall())
+        return self._reader().execute("SELECT COUNT(*) FROM illust;").fetchone()[0]
+
+    def close(self):
+        """Commit pending writes and close all connections"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        with self._readers_lock:
+            for connection in self._readers:
+                connection.close()
+            self._readers.clear()
+
+    def flush(self):
+        """Wait until all writes submitted before are committed"""
+        self._submit(lambda connection: None).result()
+
+    @staticmethod
+    def _close_reader(readers: set, lock, connection):
+        with lock:
+            if connection not in readers:
+                return  # closed by close()
+            readers.discard(connection)
+        connection.close()
+
+    def _reader(self) -> sqlite3.Connection:
+        """Read-only connection of current thread, closed when the thread ends"""
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            connection = sqlite3.connect(
+                "{}?mode=ro".format(Path(self.db_path).resolve().as_uri()),
+                uri=True, isolation_level=None, check_same_thread=False
+            )
+            reader = _ThreadReader(connection)
+            with self._readers_lock:
+                self._readers.add(connection)
+            # the thread local holder is released when the thread ends, pipelines and servers start threads per call
+            weakref.finalize(reader, self._close_reader, self._readers, self._readers_lock, connection)
+            self._local.reader = reader
+        if reader.shard_version != self._shard_version:
+            reader.shard_version = self._shard_version
+            self._attach_shards(reader.connection, read_only=True)
+        return reader.connection
+
+    # Sharding
+
+    def _shard_path(self, path) -> str:
+        """Path of a shard file, shard files are always in dir of main database
+
+        Note:
+            Only file name of path is used, paths stored by older versions were relative to cwd
+        """
+        return str(Path(self.db_path).parent / Path(path).name)
+
+    def _shard_ranges(self, shards: list = None) -> list:
+        """Returns: [(name, condition of illust id column in the shard, as a format string of column), ...]"""
+        shards = shards or self._shards
+        ranges = []
+        for i, (low, name, _) in enumerate(shards):
+            conditions = []
+            if i > 0:
+                conditions.append('"{{0}}" >= {}'.format(low))
+            if i + 1 < len(shards):
+                conditions.append('"{{0}}" < {}'.format(shards[i + 1][0]))
+            ranges.append((name, " AND ".join(conditions) or "1"))
+        return ranges
+
+    def _attach_shards(self, connection, read_only: bool = False):
+        """Attach shard files not attached yet, and recreate TEMP VIEWs over all shards"""
+        attached = {row[1] for row in connection.execute("PRAGMA database_list;")}
+        for _, name, path in self._shards:
+            if name in attached:
+                continue
+            # ATTACH creates missing files, which would hide rows of a moved shard
+            path = self._shard_path(path)
+            if not os.path.exists(path):
+                raise sqlite3.OperationalError("Shard file not found: {}".format(path))
+            if read_only:
+                connection.execute("ATTACH DATABASE ? AS \"{}\";".format(name), ("{}?mode=ro".format(Path(path).resolve().as_uri()),))
+            else:
+                connection.execute("ATTACH DATABASE ? AS \"{}\";".format(name), (path,))
+                connection.execute('PRAGMA "{}".journal_mode=WAL;'.format(name))
+
+        for table in [*self.sharded_tables, "tag"]:
+            connection.execute('DROP VIEW IF EXISTS temp."{}";'.format(table))
+        if len(self._shards) > 1:
+            # rows moved out of a shard are deleted later, so each shard is filtered by its range
+            for table, column in self.sharded_tables.items():
+                connection.execute('CREATE TEMP VIEW "{}" AS {};'.format(table, " UNION ALL ".join(
+                    'SELECT * FROM "{}"."{}" WHERE {}'.format(name, table, condition.format(column))
+                    for name, condition in self._shard_ranges()
+                )))
+            connection.execute(
+                """CREATE TEMP VIEW "tag" AS
+                SELECT tag_name.name AS name, illust_tag.illust_id AS illust_id
+                FROM illust_tag JOIN main.tag_name ON tag_name.id = illust_tag.tag_id;"""
+            )
 
-    def _init(self):
-        cursor = self.connection.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    def _load_shards(self, connection):
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "shard" (
+                "name" TEXT NOT NULL,
+                "path" TEXT NOT NULL DEFAULT '',
+                "low" INTEGER NOT NULL,
+                PRIMARY KEY ("name")
+            );"""
+        )
+        connection.execute("INSERT OR IGNORE INTO shard VALUES ('main', '', 0);")
+        self._shards = sorted((low, name, path) for name, path, low in connection.execute("SELECT * FROM main.shard;"))
+        self._attach_shards(connection)
+        self._purge_shards(connection)
+
+    def _shard_table(self, table, illust_id) -> str:
+        """Qualified name of table in the shard of illust_id"""
+        low, name, _ = self._shards[max(bisect.bisect_right(self._shards, (int(illust_id), "\uffff")) - 1, 0)]
+        return '"{}"."{}"'.format(name, table)
+
+    def _purge_shards(self, connection):
+        """Delete rows out of the range of their shards, left by splits"""
+        if len(self._shards) < 2:
+            return
+        connection.execute("BEGIN;")
+        try:
+            for name, condition in self._shard_ranges():
+                for table, column in self.sharded_tables.items():
+                    connection.execute('DELETE FROM "{}"."{}" WHERE NOT ({});'.format(name, table, condition.format(column)))
+            connection.execute("COMMIT;")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK;")
+            raise
+
+    def _split_shards(self, connection):
+        """Split shards with more than shard_max_illusts illusts, run by writer thread out of transactions
+
+        Rows are copied to the new shard, and readers switch to views over the new ranges before
+        the copied rows are deleted from the old shard, by the next call, so readers never miss rows.
+        """
+        self._purge_shards(connection)
+        for name, template in self._shard_ranges():
+            condition = template.format("id")
+            count = connection.execute('SELECT COUNT(*) FROM "{}".illust WHERE {};'.format(name, condition)).fetchone()[0]
+            if count <= self.shard_max_illusts:
+                continue
+            middle = connection.execute(
+                'SELECT id FROM "{}".illust WHERE {} ORDER BY id LIMIT 1 OFFSET ?;'.format(name, condition), (count // 2,)
+            ).fetchone()[0]
+            low = next(e[0] for e in self._shards if e[1] == name)
+            if middle <= low:
+                continue
+
+            number = max([int(e[1][5:]) for e in self._shards if e[1] != "main"], default=0) + 1
+            new_name = "shard{}".format(number)
+            db_path = Path(self.db_path)
+            new_path = "{}.{}{}".format(db_path.stem, new_name, db_path.suffix)
+            connection.execute("ATTACH DATABASE ? AS \"{}\";".format(new_name), (self._shard_path(new_path),))
+            connection.execute('PRAGMA "{}".journal_mode=WAL;'.format(new_name))
+
+            # copy schema of sharded tables from main
+            connection.execute("BEGIN;")
+            try:
+                schemas = connection.execute(
+                    "SELECT sql FROM main.sqlite_master WHERE sql IS NOT NULL AND tbl_name IN ({}) "
+                    "ORDER BY type DESC;".format(", ".join("'{}'".format(table) for table in self.sharded_tables))
+                ).fetchall()
+                for sql, in schemas:
+                    connection.execute(re.sub(r'^(CREATE (?:UNIQUE )?(?:TABLE|INDEX) )', r'\1"{}".'.format(new_name), sql))
+                for table, column in self.sharded_tables.items():
+                    connection.execute('INSERT INTO "{0}"."{2}" SELECT * FROM "{1}"."{2}" WHERE "{3}" >= ? AND {4};'.format(
+                        new_name, name, table, column, template.format(column)
+                    ), (middle,))
+                connection.execute("INSERT INTO main.shard VALUES (?, ?, ?);", (new_name, new_path, middle))
+                connection.execute("COMMIT;")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK;")
+                connection.execute('DETACH DATABASE "{}";'.format(new_name))
+                raise
+
+            self._shards = sorted([*self._shards, (middle, new_name, new_path)])
+            self._attach_shards(connection)
+            self._shard_version += 1
+            self.logger.info("Database:Split shard {} at illust id {} into {}".format(name, middle, new_name))
+
+    def split_shards(self):
+        """Split shards larger than shard_max_illusts now, instead of waiting for the writer to check"""
+        self._split_requested = True
+        self.flush()
+
+    def _submit(self, func) -> Future:
+        """Submit func(connection) to writer thread"""
+        if not self._writer.is_alive():
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        future = Future()
+        self._queue.put((func, future))
+        return future
+
+    def _write_loop(self, ready: Future):
+        connection = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL;")
+            self._init(connection)
+            self._load_shards(connection)
+        except Exception as e:
+            connection.close()
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+
+        stop = False
+        batches = 0
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stop = True
+                batch.pop()
+
+            # each call is in its own savepoint, so a failed call won't affect others in the batch
+            results = []
+            with pyxivtrace.span("db_write", calls=len(batch)):
+                connection.execute("BEGIN;")
+                for func, future in batch:
+                    connection.execute("SAVEPOINT call;")
+                    try:
+                        results.append((future, func(connection), None))
+                        connection.execute("RELEASE call;")
+                        self._batch_tag_ids.update(self._call_tag_ids)
+                    except Exception as e:
+                        connection.execute("ROLLBACK TO call;")
+                        connection.execute("RELEASE call;")
+                        results.append((future, None, e))
+                    self._call_tag_ids.clear()
+                try:
+                    with pyxivtrace.span("db_commit"):
+                        connection.execute("COMMIT;")
+                    self._tag_ids.update(self._batch_tag_ids)
+                except sqlite3.Error as e:
+                    connection.execute("ROLLBACK;")
+                    results = [(future, None, e) for future, *_ in results]
+                # ids of rolled back rows may be reused for other names
+                self._batch_tag_ids.clear()
+
+            # ATTACH can not run in a transaction, so shards are split between batches
+            batches += 1
+            if self.shard_max_illusts and (batches % 64 == 0 or self._split_requested):
+                self._split_requested = False
+                try:
+                    with pyxivtrace.span("db_split"):
+                        self._split_shards(connection)
+                except sqlite3.Error as e:
+                    self.logger.error("Database:Failed to split shards:{}".format(e))
+
+            # only notify callers after commit, so their rows are visible to readers
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+        connection.close()
+
+    def _init(self, connection):
+        cursor = connection.execute("SELECT name FROM sqlite_master WHERE type='table';")
         if not cursor.fetchall():
-            self.connection.execute(
+            connection.execute(
                 """CREATE TABLE "user" (
                     "id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
                     "name" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
                     PRIMARY KEY ("id") ON CONFLICT REPLACE
                 );"""
             )
-            self.connection.execute(
+            connection.execute(
                 """CREATE TABLE "illust" (
                     "id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
                     "title" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
@@ -110,35 +640,303 @@ class PyxivDatabase:
                     FOREIGN KEY ("user_id") REFERENCES "user" ("id") ON DELETE CASCADE ON UPDATE CASCADE
                 );"""
             )
-            self.connection.execute(
+            connection.execute(
                 """CREATE TABLE "page" (
                     "illust_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
                     "page_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
                     "url_original" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
+                    "url_regular" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
+                    "url_small" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
+                    "url_thumb_mini" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
                     PRIMARY KEY ("illust_id", "page_id") ON CONFLICT REPLACE,
                     FOREIGN KEY ("illust_id") REFERENCES "illust" ("id") ON DELETE CASCADE ON UPDATE CASCADE
                 );"""
             )
-            self.connection.execute(
-                """CREATE TABLE "tag" (
-                    "name" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE,
-                    "illust_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
-                    PRIMARY KEY ("name", "illust_id") ON CONFLICT REPLACE,
-                    FOREIGN KEY ("illust_id") REFERENCES "illust" ("id") ON DELETE CASCADE ON UPDATE CASCADE
-                );"""
-            )
 
-    @wrapper.database_operation()
-    def insert_user(self, id_, name):
-        self.connection.execute(
+        # migrate page table created before size variants were stored
+        page_columns = [row[1] for row in connection.execute("PRAGMA table_info(page);").fetchall()]
+        for column in ["url_regular", "url_small", "url_thumb_mini"]:
+            if column not in page_columns:
+                connection.execute(
+                    "ALTER TABLE page ADD COLUMN \"{}\" TEXT NOT NULL ON CONFLICT REPLACE DEFAULT '' COLLATE NOCASE;".format(column)
+                )
+
+        # dictionary encoded tags, migrate rows of old "tag" table if exists
+        tables = dict(connection.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view');").fetchall())
+        if "tag_name" not in tables:
+            connection.execute("BEGIN;")
+            try:
+                connection.execute(
+                    """CREATE TABLE "tag_name" (
+                        "id" INTEGER NOT NULL,
+                        "name" TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+                        PRIMARY KEY ("id"),
+                        UNIQUE ("name") ON CONFLICT IGNORE
+                    );"""
+                )
+                connection.execute(
+                    """CREATE TABLE "illust_tag" (
+                        "tag_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
+                        "illust_id" INTEGER NOT NULL ON CONFLICT REPLACE DEFAULT 0,
+                        PRIMARY KEY ("tag_id", "illust_id") ON CONFLICT IGNORE,
+                        FOREIGN KEY ("tag_id") REFERENCES "tag_name" ("id") ON DELETE CASCADE ON UPDATE CASCADE,
+                        FOREIGN KEY ("illust_id") REFERENCES "illust" ("id") ON DELETE CASCADE ON UPDATE CASCADE
+                    );"""
+                )
+                connection.execute('CREATE INDEX "illust_tag_illust_id" ON "illust_tag" ("illust_id", "tag_id");')
+                if tables.get("tag") == "table":
+                    connection.execute("INSERT INTO tag_name (name) SELECT name FROM tag GROUP BY name;")
+                    connection.execute(
+                        "INSERT INTO illust_tag SELECT tag_name.id, tag.illust_id FROM tag JOIN tag_name ON tag_name.name = tag.name;"
+                    )
+                    connection.execute("DROP TABLE tag;")
+                connection.execute(
+                    """CREATE VIEW "tag" AS
+                        SELECT tag_name.name AS name, illust_tag.illust_id AS illust_id
+                        FROM illust_tag JOIN tag_name ON tag_name.id = illust_tag.tag_id;"""
+                )
+                connection.execute("COMMIT;")
+            except Exception:
+                # leave no open transaction on the connection of writer thread
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK;")
+                raise
+
+        # stats history and trending score
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "illust_stats" (
+                "illust_id" INTEGER NOT NULL,
+                "epoch" INTEGER NOT NULL,
+                "bookmark_count" INTEGER NOT NULL DEFAULT 0,
+                "like_count" INTEGER NOT NULL DEFAULT 0,
+                "view_count" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("illust_id", "epoch") ON CONFLICT REPLACE
+            ) WITHOUT ROWID;"""
+        )
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "illust_trending" (
+                "illust_id" INTEGER NOT NULL,
+                "score" REAL NOT NULL DEFAULT 0,
+                "epoch" INTEGER NOT NULL DEFAULT 0,
+                "bookmark_count" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("illust_id") ON CONFLICT REPLACE
+            );"""
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS "illust_trending_score" ON "illust_trending" ("score");')
+
+        # write generation and cached search results
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "meta" (
+                "key" TEXT NOT NULL,
+                "value" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("key") ON CONFLICT REPLACE
+            );"""
+        )
+        connection.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0);")
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "search_result" (
+                "key" TEXT NOT NULL,
+                "generation" INTEGER NOT NULL DEFAULT 0,
+                "result" TEXT NOT NULL DEFAULT '[]',
+                PRIMARY KEY ("key") ON CONFLICT REPLACE
+            );"""
+        )
+
+        # recommendation graph
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "edge" (
+                "kind" INTEGER NOT NULL,
+                "src" INTEGER NOT NULL,
+                "dst" INTEGER NOT NULL,
+                "rank" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("kind", "src", "dst") ON CONFLICT IGNORE
+            ) WITHOUT ROWID;"""
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS "edge_dst" ON "edge" ("kind", "dst");')
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "edge_fetch" (
+                "kind" INTEGER NOT NULL,
+                "src" INTEGER NOT NULL,
+                "epoch" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("kind", "src") ON CONFLICT REPLACE
+            ) WITHOUT ROWID;"""
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS "edge_fetch_epoch" ON "edge_fetch" ("kind", "epoch");')
+        connection.execute('CREATE INDEX IF NOT EXISTS "illust_bookmark_count" ON "illust" ("bookmark_count");')
+
+        # ranking archive, date is like "20210319"
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "ranking" (
+                "date" TEXT NOT NULL,
+                "mode" TEXT NOT NULL,
+                "content" TEXT NOT NULL,
+                "rank" INTEGER NOT NULL,
+                "illust_id" INTEGER NOT NULL,
+                "yes_rank" INTEGER NOT NULL DEFAULT 0,
+                "view_count" INTEGER NOT NULL DEFAULT 0,
+                "rating_count" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("date", "mode", "content", "rank") ON CONFLICT REPLACE
+            ) WITHOUT ROWID;"""
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS "ranking_illust_id" ON "ranking" ("illust_id");')
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "ranking_fetch" (
+                "date" TEXT NOT NULL,
+                "mode" TEXT NOT NULL,
+                "content" TEXT NOT NULL,
+                "rank_total" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("date", "mode", "content") ON CONFLICT REPLACE
+            ) WITHOUT ROWID;"""
+        )
+
+        # newest result of last incremental search
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "search_watermark" (
+                "keyword" TEXT NOT NULL,
+                "category" TEXT NOT NULL,
+                "mode" TEXT NOT NULL,
+                "s_mode" TEXT NOT NULL,
+                "max_illust_id" INTEGER NOT NULL DEFAULT 0,
+                "total" INTEGER NOT NULL DEFAULT 0,
+                "epoch" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("keyword", "category", "mode", "s_mode") ON CONFLICT REPLACE
+            ) WITHOUT ROWID;"""
+        )
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "search_retry" (
+                "keyword" TEXT NOT NULL,
+                "category" TEXT NOT NULL,
+                "mode" TEXT NOT NULL,
+                "s_mode" TEXT NOT NULL,
+                "illust_id" INTEGER NOT NULL,
+                "attempts" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("keyword", "category", "mode", "s_mode", "illust_id") ON CONFLICT REPLACE
+            ) WITHOUT ROWID;"""
+        )
+
+        # sync state of users for save_all
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "user_sync" (
+                "user_id" INTEGER PRIMARY KEY ON CONFLICT REPLACE,
+                "synced_epoch" INTEGER NOT NULL,
+                "next_epoch" INTEGER NOT NULL,
+                "max_illust_id" INTEGER NOT NULL DEFAULT 0,
+                "illust_count" INTEGER NOT NULL DEFAULT 0,
+                "post_rate" REAL NOT NULL DEFAULT 0,
+                "interval" INTEGER NOT NULL
+            );"""
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS "user_sync_next_epoch" ON "user_sync" ("next_epoch");')
+
+        # downloaded files of pages, filled by PyxivImageProcessor
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "page_file" (
+                "illust_id" INTEGER NOT NULL,
+                "page_id" INTEGER NOT NULL,
+                "size" TEXT NOT NULL,
+                "path" TEXT NOT NULL,
+                "format" TEXT NOT NULL DEFAULT "",
+                "width" INTEGER NOT NULL DEFAULT 0,
+                "height" INTEGER NOT NULL DEFAULT 0,
+                "bytes" INTEGER NOT NULL DEFAULT 0,
+                "frames" INTEGER NOT NULL DEFAULT 1,
+                "thumb_path" TEXT NOT NULL DEFAULT "",
+                "attempts" INTEGER NOT NULL DEFAULT 0,
+                "error" TEXT NOT NULL DEFAULT "",
+                PRIMARY KEY ("illust_id", "page_id", "size") ON CONFLICT REPLACE
+            ) WITHOUT ROWID;"""
+        )
+        page_file_columns = [row[1] for row in connection.execute("PRAGMA table_info(page_file);").fetchall()]
+        if "attempts" not in page_file_columns:
+            connection.execute('ALTER TABLE page_file ADD COLUMN "attempts" INTEGER NOT NULL DEFAULT 0;')
+            connection.execute('ALTER TABLE page_file ADD COLUMN "error" TEXT NOT NULL DEFAULT "";')
+
+        # perceptual hashes of pages
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "page_hash" (
+                "illust_id" INTEGER NOT NULL,
+                "page_id" INTEGER NOT NULL,
+                "hash" INTEGER NOT NULL,
+                "c0" INTEGER NOT NULL,
+                "c1" INTEGER NOT NULL,
+                "c2" INTEGER NOT NULL,
+                "c3" INTEGER NOT NULL,
+                "downloaded" INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ("illust_id", "page_id") ON CONFLICT REPLACE
+            ) WITHOUT ROWID;"""
+        )
+        for i in range(4):
+            connection.execute('CREATE INDEX IF NOT EXISTS "page_hash_c{0}" ON "page_hash" ("c{0}");'.format(i))
+
+        # persistent job queue of PyxivDaemon
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS "job" (
+                "id" INTEGER NOT NULL,
+                "method" TEXT NOT NULL,
+                "args" TEXT NOT NULL DEFAULT '[]',
+                "kwargs" TEXT NOT NULL DEFAULT '{}',
+                "kind" TEXT NOT NULL,
+                "priority" INTEGER NOT NULL DEFAULT 0,
+                "state" TEXT NOT NULL DEFAULT 'queued',
+                "created" INTEGER NOT NULL,
+                "started" INTEGER NOT NULL DEFAULT 0,
+                "finished" INTEGER NOT NULL DEFAULT 0,
+                "result" TEXT NOT NULL DEFAULT '',
+                "error" TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY ("id")
+            );"""
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS "job_state" ON "job" ("state", "priority", "id");')
+
+    @property
+    def generation(self) -> int:
+        """Write generation of database, shared by all processes using the same database file"""
+        return self._reader().execute("SELECT value FROM meta WHERE key = 'generation';").fetchone()[0]
+
+    def _bump_generation(self, connection):
+        connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation';")
+
+    def iter_illust_tags(self, position: dict, chunk_size: int = 10000):
+        """Iterate rows of illust_tag inserted after position, for incremental readers
+
+        Args:
+            position: {} to read all rows, updated in place as rows are read, so the next call only reads new rows.
+                If shards changed since position was updated, all rows are read again, and position["reset"] is set to True
+
+        Yields:
+            list: [(tag_id, illust_id), ...] in chunks of chunk_size
+        """
+        shards = self._shards
+        if position.get("shards") != shards:
+            position.clear()
+            position.update(shards=shards, rowids={}, reset=True)
+        # attaches all shards of the snapshot, shards are never removed
+        connection = self._reader()
+        for name, condition in self._shard_ranges(shards):
+            while True:
+                rows = connection.execute(
+                    'SELECT rowid, tag_id, illust_id FROM "{}".illust_tag WHERE rowid > ? AND {} ORDER BY rowid LIMIT ?;'.format(
+                        name, condition.format("illust_id")
+                    ),
+                    (position["rowids"].get(name, 0), chunk_size)
+                ).fetchall()
+                if not rows:
+                    break
+                position["rowids"][name] = rows[-1][0]
+                yield [row[1:] for row in rows]
+
+    @wrapper.database_write()
+    def insert_user(self, connection, id_, name):
+        connection.execute(
             "INSERT INTO user VALUES (?, ?);",
             (id_, name)
         )
+        self._bump_generation(connection)
 
-    @wrapper.database_operation()
-    def insert_illust(self, id_, title, description, bookmark_count, like_count, view_count, user_id, x_restrict, upload_date):
-        self.connection.execute(
-            "INSERT INTO illust VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+    @wrapper.database_write()
+    def insert_illust(self, connection, id_, title, description, bookmark_count, like_count, view_count, user_id, x_restrict, upload_date):
+        connection.execute(
+            "INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);".format(self._shard_table("illust", id_)),
             (
                 id_, title, description,
                 bookmark_count, like_count, view_count,
@@ -147,19 +945,1088 @@ class PyxivDatabase:
             )
         )
 
+        epoch = int(time())
+        connection.execute(
+            "INSERT INTO illust_stats VALUES (?, ?, ?, ?, ?);",
+            (id_, epoch, bookmark_count, like_count, view_count)
+        )
+
+        # update trending score incrementally from the last refresh
+        score = 0.0
+        last = connection.execute(
+            "SELECT score, epoch, bookmark_count FROM illust_trending WHERE illust_id = ?;",
+            (id_,)
+        ).fetchone()
+        if last:
+            last_score, last_epoch, last_bookmark_count = last
+            if epoch > last_epoch:
+                velocity = (bookmark_count - last_bookmark_count) * 86400 / (epoch - last_epoch)
+                weight = 1 - 0.5 ** ((epoch - last_epoch) / self.trending_half_life)
+                score = last_score + weight * (velocity - last_score)
+        if not last or epoch > last[1]:
+            connection.execute(
+                "INSERT INTO illust_trending VALUES (?, ?, ?, ?);",
+                (id_, score, epoch, bookmark_count)
+            )
+        self._bump_generation(connection)
+
+    @wrapper.database_write()
+    def insert_page(self, connection, illust_id, page_id, url_original, url_regular="", url_small="", url_thumb_mini=""):
+        connection.execute(
+            "INSERT INTO {} (illust_id, page_id, url_original, url_regular, url_small, url_thumb_mini) "
+            "VALUES (?, ?, ?, ?, ?, ?);".format(self._shard_table("page", illust_id)),
+            (illust_id, page_id, url_original, url_regular, url_small, url_thumb_mini)
+        )
+        self._bump_generation(connection)
+
+    def _get_tag_id(self, connection, name) -> int:
+        for tag_ids in (self._tag_ids, self._batch_tag_ids, self._call_tag_ids):
+            tag_id = tag_ids.get(name)
+            if tag_id is not None:
+                return tag_id
+        connection.execute("INSERT INTO tag_name (name) VALUES (?);", (name,))
+        tag_id = connection.execute("SELECT id FROM tag_name WHERE name = ?;", (name,)).fetchone()[0]
+        self._call_tag_ids[name] = tag_id
+        return tag_id
+
+    @wrapper.database_write()
+    def insert_tag(self, connection, name, illust_id):
+        connection.execute(
+            "INSERT INTO {} VALUES (?, ?);".format(self._shard_table("illust_tag", illust_id)),
+            (self._get_tag_id(connection, name), illust_id)
+        )
+        self._bump_generation(connection)
+
+    @wrapper.database_write()
+    def insert_tags(self, connection, names, illust_id):
+        """Insert all tags of an illust"""
+        connection.executemany(
+            "INSERT INTO {} VALUES (?, ?);".format(self._shard_table("illust_tag", illust_id)),
+            [(self._get_tag_id(connection, name), illust_id) for name in names]
+        )
+        self._bump_generation(connection)
+
+    @wrapper.database_write()
+    def insert_page_file(
+            self, connection, illust_id, page_id, size, path, format_, width, height, bytes_, frames, thumb_path,
+            attempts: int = 0, error: str = ""):
+        connection.execute(
+            "INSERT INTO page_file VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+            (illust_id, page_id, size, path, format_, width, height, bytes_, frames, thumb_path, attempts, error)
+        )
+
+    @staticmethod
+    def _hash_chunks(hash_) -> list:
+        return [(hash_ >> (48 - 16 * i)) & 0xFFFF for i in range(4)]
+
+    @wrapper.database_write()
+    def insert_page_hash(self, connection, illust_id, page_id, hash_, downloaded: bool = False):
+        """Store 64 bit unsigned perceptual hash of a page, a page is only matched by find_similar_pages if downloaded"""
+        connection.execute(
+            "INSERT INTO page_hash VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+            (illust_id, page_id, hash_ - (hash_ >> 63 << 64), *self._hash_chunks(hash_), int(downloaded))
+        )
+
+    @wrapper.database_write()
+    def set_page_downloaded(self, connection, illust_id, page_id):
+        connection.execute("UPDATE page_hash SET downloaded = 1 WHERE illust_id = ? AND page_id = ?;", (illust_id, page_id))
+
+    @wrapper.database_operation()
+    def find_similar_pages(self, hash_, max_distance: int = 4, exclude_illust_id=None) -> list:
+        """Find downloaded pages whose hash is within Hamming distance max_distance of hash_
+
+        Returns:
+            list: [(illust_id, page_id, distance), ...], nearest first
+        """
+        if not 0 <= max_distance < 64:
+            raise ValueError("Incorrect max_distance value: {}".format(max_distance))
+        # pigeonhole: a match differs from hash_ in at most max_distance // 4 bits of some chunk
+        chunk_distance = max_distance // 4
+        # all masks of at most chunk_distance bits, including 0 for an equal chunk
+        masks = {0}
+        for _ in range(chunk_distance):
+            masks |= {mask | (1 << bit) for mask in masks for bit in range(16)}
+
+        candidates = {}
+        connection = self._reader()
+        for i, chunk in enumerate(self._hash_chunks(hash_)):
+            values = list({chunk ^ mask for mask in masks})
+            for start in range(0, len(values), 500):
+                part = values[start:start + 500]
+                for illust_id, page_id, other in connection.execute(
+                    "SELECT illust_id, page_id, hash FROM page_hash WHERE c{} IN ({}) AND downloaded = 1;".format(
+                        i, ", ".join("?" * len(part))
+                    ),
+                    part
+                ):
+                    candidates[(illust_id, page_id)] = other & 0xFFFFFFFFFFFFFFFF
+
+        results = []
+        for (illust_id, page_id), other in candidates.items():
+            distance = (hash_ ^ other).bit_count()
+            if distance <= max_distance and illust_id != exclude_illust_id:
+                results.append((illust_id, page_id, distance))
+        return sorted(results, key=lambda e: e[2])
+
+    # Job queue
+
+    @wrapper.database_write()
+    def insert_job(self, connection, method, args, kwargs, kind, priority: int = 0) -> int:
+        """Queue a job, args and kwargs are json strings
+
+        Returns:
+            int: id of job
+        """
+        return connection.execute(
+            "INSERT INTO job (method, args, kwargs, kind, priority, created) VALUES (?, ?, ?, ?, ?, ?);",
+            (method, args, kwargs, kind, priority, int(time()))
+        ).lastrowid
+
+    @wrapper.database_write()
+    def set_job_state(self, connection, job_id, state, result: str = "", error: str = "") -> bool:
+        """Returns False if the job was not changed, only queued jobs can be set running"""
+        if state not in ("running", "done", "failed"):
+            raise ValueError("Incorrect state value: {}".format(state))
+        if state == "running":
+            return connection.execute(
+                "UPDATE job SET state = ?, started = ? WHERE id = ? AND state = 'queued';", (state, int(time()), job_id)
+            ).rowcount > 0
+        return connection.execute(
+            "UPDATE job SET state = ?, finished = ?, result = ?, error = ? WHERE id = ?;",
+            (state, int(time()), result, error, job_id)
+        ).rowcount > 0
+
+    @wrapper.database_write()
+    def cancel_job(self, connection, job_id) -> bool:
+        """Cancel a queued job, returns False if the job is not queued"""
+        return connection.execute(
+            "UPDATE job SET state = 'cancelled', finished = ? WHERE id = ? AND state = 'queued';", (int(time()), job_id)
+        ).rowcount > 0
+
+    @wrapper.database_write()
+    def requeue_jobs(self, connection) -> int:
+        """Queue again jobs left running by an interrupted process, returns number of jobs"""
+        return connection.execute("UPDATE job SET state = 'queued' WHERE state = 'running';").rowcount
+
+    def _job_rows(self, sql, parameters) -> list:
+        cursor = self._reader().execute(sql, parameters)
+        columns = [e[0] for e in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    @wrapper.database_operation()
+    def get_next_job(self, exclude_kinds: list = None) -> dict:
+        """Queued job of highest priority, earliest first, excluding kinds in exclude_kinds, None if no job"""
+        exclude_kinds = exclude_kinds or []
+        rows = self._job_rows(
+            "SELECT * FROM job WHERE state = 'queued' AND kind NOT IN ({}) ORDER BY priority DESC, id LIMIT 1;".format(
+                ", ".join("?" * len(exclude_kinds))
+            ),
+            exclude_kinds
+        )
+        return rows[0] if rows else None
+
+    @wrapper.database_operation()
+    def get_job(self, job_id) -> dict:
+        """Returns: row of job as a dict, {} if not found"""
+        rows = self._job_rows("SELECT * FROM job WHERE id = ?;", (job_id,))
+        return rows[0] if rows else {}
+
+    @wrapper.database_operation()
+    def get_jobs(self, states: list = None, limit: int = 100) -> list:
+        """Returns: rows of jobs in states as dicts, newest first, all states if states is None"""
+        if states:
+            return self._job_rows(
+                "SELECT * FROM job WHERE state IN ({}) ORDER BY id DESC LIMIT ?;".format(", ".join("?" * len(states))),
+                [*states, limit]
+            )
+        return self._job_rows("SELECT * FROM job ORDER BY id DESC LIMIT ?;", (limit,))
+
+    @wrapper.database_write()
+    def insert_search_result(self, connection, key, generation, result, max_bytes: int = None):
+        """Store a serialized search result, won't change generation of database
+
+        Args:
+            max_bytes: Evict the oldest results when results exceed max_bytes in total, None for no limit
+        """
+        # results of older generations are never read again
+        connection.execute("DELETE FROM search_result WHERE generation < ?;", (generation,))
+        connection.execute(
+            "INSERT INTO search_result VALUES (?, ?, ?);",
+            (key, generation, result)
+        )
+        if max_bytes is not None:
+            connection.execute(
+                """DELETE FROM search_result WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, SUM(LENGTH(result)) OVER (ORDER BY rowid DESC) AS total FROM search_result
+                    ) WHERE total > ?
+                );""",
+                (max_bytes,)
+            )
+
+    @wrapper.database_write()
+    def insert_ranking(self, connection, date, mode, content, contents: list, rank_total: int):
+        """Store all contents of a ranking from get_ranking, and users of its illusts
+
+        Args:
+            contents: concatenated "contents" of all pages of the ranking
+        """
+        connection.executemany(
+            "INSERT INTO ranking VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+            [
+                (
+                    date, mode, content, e.get("rank"), e.get("illust_id"),
+                    e.get("yes_rank") or 0, e.get("view_count") or 0, e.get("rating_count") or 0
+                )
+                for e in contents
+            ]
+        )
+        connection.executemany(
+            "INSERT INTO user VALUES (?, ?);",
+            list({e.get("user_id"): e.get("user_name") for e in contents}.items())
+        )
+        connection.execute("INSERT INTO ranking_fetch VALUES (?, ?, ?, ?);", (date, mode, content, rank_total))
+        self._bump_generation(connection)
+
+    @wrapper.database_write()
+    def insert_search_watermark(self, connection, keyword, category, mode, s_mode, max_illust_id, total):
+        connection.execute(
+            "INSERT INTO search_watermark VALUES (?, ?, ?, ?, ?, ?, ?);",
+            (keyword, category, mode, s_mode, max_illust_id, total, int(time()))
+        )
+
+    @wrapper.database_write()
+    def update_search_retries(self, connection, keyword, category, mode, s_mode, failed_ids, done_ids):
+        """Count a failed attempt of failed_ids, and remove done_ids and illusts failed too many times"""
+        key = (keyword, category, mode, s_mode)
+        connection.executemany(
+            "DELETE FROM search_retry WHERE keyword = ? AND category = ? AND mode = ? AND s_mode = ? AND illust_id = ?;",
+            [(*key, illust_id) for illust_id in done_ids]
+        )
+        connection.executemany(
+            """INSERT INTO search_retry VALUES (?, ?, ?, ?, ?, 1 + COALESCE((
+                SELECT attempts FROM search_retry WHERE keyword = ? AND category = ? AND mode = ? AND s_mode = ? AND illust_id = ?
+            ), 0));""",
+            [(*key, illust_id, *key, illust_id) for illust_id in failed_ids]
+        )
+        connection.execute(
+            "DELETE FROM search_retry WHERE keyword = ? AND category = ? AND mode = ? AND s_mode = ? AND attempts >= ?;",
+            (*key, self.search_retry_max_attempts)
+        )
+
     @wrapper.database_operation()
-    def insert_page(self, illust_id, page_id, url_original):
-        self.connection.execute(
-            "INSERT INTO page VALUES (?, ?, ?);",
-            (illust_id, page_id, url_original)
+    def get_search_retries(self, keyword, category, mode, s_mode) -> list:
+        """Returns: ids of illusts to retry for an incremental search"""
+        return [row[0] for row in self._reader().execute(
+            "SELECT illust_id FROM search_retry WHERE keyword = ? AND category = ? AND mode = ? AND s_mode = ? ORDER BY illust_id;",
+            (keyword, category, mode, s_mode)
+        )]
+
+    @wrapper.database_operation()
+    def get_search_watermark(self, keyword, category, mode, s_mode) -> tuple:
+        """Returns: (max_illust_id, total) of last incremental search, (0, 0) if never searched"""
+        row = self._reader().execute(
+            "SELECT max_illust_id, total FROM search_watermark WHERE keyword = ? AND category = ? AND mode = ? AND s_mode = ?;",
+            (keyword, category, mode, s_mode)
+        ).fetchone()
+        return row or (0, 0)
+
+    @wrapper.database_write()
+    def insert_user_sync(self, connection, user_id, max_illust_id, illust_count, new_count):
+        """Record a sync of user, and schedule next sync by observed posting rate
+
+        Args:
+            new_count: Number of illusts newer than max_illust_id of last sync
+        """
+        min_interval, max_interval = self.sync_interval_range
+        now = int(time())
+        row = connection.execute(
+            "SELECT synced_epoch, post_rate, interval FROM user_sync WHERE user_id = ?;", (user_id,)
+        ).fetchone()
+        if row:
+            synced_epoch, post_rate, interval = row
+            days = max(now - synced_epoch, 3600) / 86400
+            post_rate = 0.5 * post_rate + 0.5 * new_count / days
+            # back off dormant users, otherwise wait about the time to post one illust
+            interval = interval * 2 if post_rate * interval < 0.5 * 86400 else 86400 / post_rate
+        else:
+            post_rate, interval = 0.0, min_interval
+        interval = int(min(max(interval, min_interval), max_interval))
+        connection.execute(
+            "INSERT INTO user_sync VALUES (?, ?, ?, ?, ?, ?, ?);",
+            (user_id, now, now + interval, max_illust_id, illust_count, post_rate, interval)
         )
 
     @wrapper.database_operation()
-    def insert_tag(self, name, illust_id):
-        self.connection.execute(
-            "INSERT INTO tag VALUES (?, ?);",
-            (name, illust_id)
+    def get_user_sync(self, user_id) -> tuple:
+        """Returns: (synced_epoch, max_illust_id, post_rate) of last sync, None if never synced"""
+        return self._reader().execute(
+            "SELECT synced_epoch, max_illust_id, post_rate FROM user_sync WHERE user_id = ?;", (user_id,)
+        ).fetchone()
+
+    @wrapper.database_operation()
+    def get_due_users(self, limit: int = -1) -> list:
+        """Get users due to sync, never synced first, then the most overdue, then the most active
+
+        Returns:
+            list: [int(user_id), ...]
+        """
+        return [row[0] for row in self._reader().execute(
+            """SELECT user.id FROM user LEFT JOIN user_sync ON user_sync.user_id = user.id
+            WHERE COALESCE(user_sync.next_epoch, 0) <= ?
+            ORDER BY COALESCE(user_sync.next_epoch, 0), user_sync.post_rate DESC LIMIT ?;""",
+            (int(time()), limit)
+        )]
+
+    def _check_edge_kind(self, kind):
+        if kind not in self.edge_kinds:
+            raise ValueError("Incorrect kind value: {}".format(kind))
+        return self.edge_kinds[kind]
+
+    @wrapper.database_write()
+    def insert_edges(self, connection, kind, src, dsts):
+        """Replace all edges of src by dsts, in order of rank"""
+        kind_value, *_ = self._check_edge_kind(kind)
+        connection.execute("DELETE FROM edge WHERE kind = ? AND src = ?;", (kind_value, src))
+        connection.executemany(
+            "INSERT INTO edge VALUES (?, ?, ?, ?);",
+            [(kind_value, src, dst, rank) for rank, dst in enumerate(dsts)]
         )
+        connection.execute("INSERT INTO edge_fetch VALUES (?, ?, ?);", (kind_value, src, int(time())))
+
+    @wrapper.database_operation()
+    def get_edges(self, kind, src, max_age: int = None) -> list:
+        """Get dsts of src in order of rank
+
+        Args:
+            max_age: Max seconds since edges were fetched, None means no limit
+
+        Returns:
+            list: [int(id), ...], None if edges of src were never fetched or are older than max_age
+        """
+        kind_value, *_ = self._check_edge_kind(kind)
+        connection = self._reader()
+        fetch = connection.execute("SELECT epoch FROM edge_fetch WHERE kind = ? AND src = ?;", (kind_value, src)).fetchone()
+        if not fetch or (max_age is not None and time() - fetch[0] > max_age):
+            return None
+        return [row[0] for row in connection.execute(
+            "SELECT dst FROM edge WHERE kind = ? AND src = ? ORDER BY rank;", (kind_value, src)
+        )]
+
+    @wrapper.database_operation()
+    def get_frontier(self, kind, limit: int = 100) -> list:
+        """Plan crawling offline, get neighbours not saved yet, most referenced first
+
+        Returns:
+            list: [(id, number of srcs linking to it), ...]
+        """
+        kind_value, table, column = self._check_edge_kind(kind)
+        return self._reader().execute(
+            """SELECT dst, COUNT(*) AS n FROM edge
+            WHERE kind = ? AND NOT EXISTS (SELECT 1 FROM "{0}" WHERE "{0}"."{1}" = edge.dst)
+            GROUP BY dst ORDER BY n DESC LIMIT ?;""".format(table, column),
+            (kind_value, limit)
+        ).fetchall()
+
+    @wrapper.database_operation()
+    def get_unexplored_counts(self, kind, limit: int = 100) -> list:
+        """Plan crawling offline, count neighbours not saved yet for each src
+
+        Returns:
+            list: [(src, number of unsaved neighbours), ...], most unsaved neighbours first
+        """
+        kind_value, table, column = self._check_edge_kind(kind)
+        return self._reader().execute(
+            """SELECT src, COUNT(*) AS n FROM edge
+            WHERE kind = ? AND NOT EXISTS (SELECT 1 FROM "{0}" WHERE "{0}"."{1}" = edge.dst)
+            GROUP BY src ORDER BY n DESC LIMIT ?;""".format(table, column),
+            (kind_value, limit)
+        ).fetchall()
+
+    # Export and import
+
+    def _check_dump_args(self, tables, format_) -> list:
+        tables = tables or list(self.dump_columns)
+        for table in tables:
+            if table not in self.dump_columns:
+                raise ValueError("Incorrect table value: {}".format(table))
+        if format_ not in ["jsonl", "parquet"]:
+            raise ValueError("Incorrect format value: {}".format(format_))
+        if format_ == "parquet" and pyarrow is None:
+            raise ImportError("pyarrow is required for parquet format, install it by: pip install pyarrow")
+        return tables
+
+    def export_tables(self, out_dir, tables: list = None, format_="jsonl", chunk_size: int = 10000):
+        """Export tables to out_dir/<table>.<format_>, rows are read and written in chunks
+
+        Args:
+            tables: Tables to export, "user", "illust", "page", "tag", None means all
+            format_: "jsonl", "parquet"(requires pyarrow)
+            chunk_size: Number of rows in memory at a time
+        """
+        tables = self._check_dump_args(tables, format_)
+        os.makedirs(out_dir, exist_ok=True)
+
+        # export all tables from the same snapshot
+        connection = self._reader()
+        connection.execute("BEGIN;")
+        try:
+            for table in tables:
+                columns = self.dump_columns[table]
+                cursor = connection.execute('SELECT {} FROM "{}";'.format(", ".join(columns), table))
+                path = Path(out_dir, "{}.{}".format(table, format_))
+                if format_ == "jsonl":
+                    with open(path, "w", encoding="utf8") as f:
+                        for rows in iter(lambda: cursor.fetchmany(chunk_size), []):
+                            f.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+                else:
+                    writer = None
+                    for rows in iter(lambda: cursor.fetchmany(chunk_size), []):
+                        batch = pyarrow.Table.from_pylist([dict(zip(columns, row)) for row in rows])
+                        writer = writer or pyarrow.parquet.ParquetWriter(path, batch.schema)
+                        writer.write_table(batch)
+                    if writer:
+                        writer.close()
+        finally:
+            connection.execute("COMMIT;")
+
+    def _iter_dump_chunks(self, path: Path, chunk_size):
+        if path.suffix == ".parquet":
+            for batch in pyarrow.parquet.ParquetFile(path).iter_batches(chunk_size):
+                yield batch.to_pylist()
+        else:
+            with open(path, "r", encoding="utf8") as f:
+                rows = []
+                for line in f:
+                    if line.strip():
+                        rows.append(json.loads(line))
+                    if len(rows) >= chunk_size:
+                        yield rows
+                        rows = []
+                if rows:
+                    yield rows
+
+    def import_tables(
+            self, in_dir, tables: list = None, format_="jsonl", chunk_size: int = 10000, max_pending_rows: int = 50000) -> int:
+        """Import rows exported by export_tables, used to merge databases
+
+        Rows are inserted by executemany in large transactions, and secondary indexes are rebuilt after import.
+        Existing illusts are only replaced by rows with a newer last_update_date,
+        tags are matched by name, so databases with different tag ids can be merged.
+
+        Args:
+            max_pending_rows: Max rows read but not committed yet, reading waits for commits beyond it
+
+        Returns:
+            int: Number of rows read
+        """
+        tables = self._check_dump_args(tables, format_)
+        sqls = {
+            "user": "INSERT INTO user (id, name) VALUES (?, ?);",
+            "illust": (
+                "INSERT INTO {{}} ({0}) VALUES ({1}) ON CONFLICT (id) DO UPDATE SET {2} "
+                "WHERE excluded.last_update_date > illust.last_update_date;"
+            ).format(
+                ", ".join(self.dump_columns["illust"]),
+                ", ".join("?" * len(self.dump_columns["illust"])),
+                ", ".join("{0} = excluded.{0}".format(column) for column in self.dump_columns["illust"][1:])
+            ),
+            "page": "INSERT INTO {{}} ({}) VALUES (?, ?, ?, ?, ?, ?);".format(", ".join(self.dump_columns["page"])),
+            "tag": "INSERT INTO {} VALUES (?, ?);",
+        }
+        id_columns = {"illust": ("illust", "id"), "page": ("page", "illust_id"), "tag": ("illust_tag", "illust_id")}
+
+        def insert_chunk(connection, table, rows):
+            if table == "tag":
+                rows = [(self._get_tag_id(connection, row["name"]), row["illust_id"]) for row in rows]
+            else:
+                # missing columns get empty values, e.g. pages exported before size variants
+                columns = self.dump_columns[table]
+                rows = [tuple(row.get(column, "") for column in columns) for row in rows]
+            if table not in id_columns:
+                connection.executemany(sqls[table], rows)
+                return
+            # route rows to shards by illust id
+            sharded_table, column = id_columns[table]
+            index = self.dump_columns[table].index(column) if table != "tag" else 1
+            shard_rows = {}
+            for row in rows:
+                shard_rows.setdefault(self._shard_table(sharded_table, row[index]), []).append(row)
+            for shard_table, rows in shard_rows.items():
+                connection.executemany(sqls[table].format(shard_table), rows)
+
+        def drop_indexes(connection):
+            indexes = []
+            for _, name, _ in self._shards:
+                for index, sql in connection.execute(
+                    'SELECT name, sql FROM "{}".sqlite_master '
+                    "WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ('illust', 'page', 'illust_tag');".format(name)
+                ).fetchall():
+                    connection.execute('DROP INDEX "{}"."{}";'.format(name, index))
+                    indexes.append(re.sub(r'^(CREATE (?:UNIQUE )?INDEX )', r'\1"{}".'.format(name), sql))
+            return indexes
+
+        def create_indexes(connection, indexes):
+            for sql in indexes:
+                connection.execute(sql)
+            self._bump_generation(connection)
+
+        indexes = self._submit(drop_indexes).result()
+        count = 0
+        pending = deque()  # (future, number of rows) of chunks not committed yet
+        pending_rows = 0
+        failed = []
+        try:
+            for table in tables:
+                path = Path(in_dir, "{}.{}".format(table, format_))
+                if not path.exists():
+                    continue
+                for rows in self._iter_dump_chunks(path, chunk_size):
+                    # bound rows in memory by waiting for the oldest chunks
+                    while pending and pending_rows + len(rows) > max_pending_rows:
+                        future, n = pending.popleft()
+                        pending_rows -= n
+                        if future.exception():
+                            failed.append(future)
+                    pending.append((
+                        self._submit(lambda connection, table=table, rows=rows: insert_chunk(connection, table, rows)),
+                        len(rows)
+                    ))
+                    pending_rows += len(rows)
+                    count += len(rows)
+        finally:
+            self._submit(lambda connection: create_indexes(connection, indexes)).result()
+        for future in [*failed, *(future for future, _ in pending)]:
+            future.result()
+        return count
+
+
+class PyxivResultCache:
+    """LRU cache for search results of PyxivDatabase
+
+    Results are valid only for the generation of database they were computed at,
+    and are also persisted in table search_result to be shared by other processes, within the same max_bytes.
+    """
+
+    def __init__(self, db: PyxivDatabase, max_bytes: int = 64 * 2**20):
+        """
+        Args:
+            max_bytes: Approximate max bytes of serialized results kept in memory
+        """
+        self.db = db
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()  # key -> (generation, result, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def _put(self, key, generation, result, nbytes):
+        with self._lock:
+            if key in self._cache:
+                self._nbytes -= self._cache.pop(key)[2]
+            if nbytes > self.max_bytes:
+                return
+            self._cache[key] = (generation, result, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                self._nbytes -= self._cache.popitem(last=False)[1][2]
+
+    def get(self, key, generation):
+        """Return cached result of key at generation, None if not found"""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] == generation:
+                self._cache.move_to_end(key)
+                return entry[1]
+
+        rows = self.db("SELECT result FROM search_result WHERE key = ? AND generation = ?;", (key, generation))
+        if rows:
+            result = [tuple(e) for e in json.loads(rows[0][0])]
+            self._put(key, generation, result, len(rows[0][0]))
+            return result
+        return None
+
+    def put(self, key, generation, result):
+        """Cache result of key computed at generation"""
+        data = json.dumps(result)
+        self._put(key, generation, result, len(data))
+        if len(data) <= self.max_bytes:
+            self.db.insert_search_result(key, generation, data, self.max_bytes)
+
+
+class PyxivIllustCache:
+    """LRU cache of illust rows with their pages, shared by download methods
+
+    Rows are dicts like {"id": int, "user_id": int, "x_restrict": int, "pages": [(url_original, url_regular, url_small, url_thumb_mini), ...]}.
+    Illusts not in database are not cached.
+    """
+
+    chunk_size = 500  # max number of ids in one IN (...)
+
+    def __init__(self, db: PyxivDatabase, max_size: int = 100000):
+        self.db = db
+        self.max_size = max_size
+        self._cache = OrderedDict()  # illust_id -> row
+        self._lock = threading.Lock()
+
+    def _fetch(self, illust_ids) -> dict:
+        rows = {}
+        for i in range(0, len(illust_ids), self.chunk_size):
+            chunk = illust_ids[i: i + self.chunk_size]
+            marks = ", ".join("?" * len(chunk))
+            for id_, user_id, x_restrict in self.db(
+                "SELECT id, user_id, x_restrict FROM illust WHERE id IN ({});".format(marks), chunk
+            ):
+                rows[id_] = {"id": id_, "user_id": user_id, "x_restrict": x_restrict, "pages": []}
+            for illust_id, *urls in self.db(
+                "SELECT illust_id, url_original, url_regular, url_small, url_thumb_mini FROM page "
+                "WHERE illust_id IN ({}) ORDER BY illust_id, page_id;".format(marks), chunk
+            ):
+                if illust_id in rows:
+                    rows[illust_id]["pages"].append(tuple(urls))
+        return rows
+
+    def get_many(self, illust_ids) -> dict:
+        """Get rows of illust_ids, prefetch uncached rows from database in batch
+
+        Returns:
+            dict: {illust_id: row}, excluding illusts not in database
+        """
+        illust_ids = list(dict.fromkeys(map(int, illust_ids)))
+        rows = {}
+        with self._lock:
+            for illust_id in illust_ids:
+                if illust_id in self._cache:
+                    self._cache.move_to_end(illust_id)
+                    rows[illust_id] = self._cache[illust_id]
+        missing_rows = self._fetch([illust_id for illust_id in illust_ids if illust_id not in rows])
+        with self._lock:
+            for illust_id, row in missing_rows.items():
+                self._cache[illust_id] = row
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        rows.update(missing_rows)
+        return rows
+
+    def get(self, illust_id) -> dict:
+        """Get row of an illust, None if not in database"""
+        return self.get_many([illust_id]).get(int(illust_id))
+
+    def invalidate(self, illust_id):
+        with self._lock:
+            self._cache.pop(int(illust_id), None)
+
+
+class PyxivIdIndex:
+    """Ids of illusts and users in database, kept in memory by a long running process like PyxivDaemon
+
+    Ids are read once, then updated by add() when illusts are saved, instead of reading all ids for each crawl.
+
+    Note:
+        Rows written by other processes are not seen until reload().
+    """
+
+    def __init__(self, db: PyxivDatabase):
+        self.db = db
+        self._illust_ids = None
+        self._user_ids = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._illust_ids is None:
+            rows = self.db("SELECT id, user_id FROM illust;")
+            self._illust_ids = set(row[0] for row in rows)
+            self._user_ids = set(row[1] for row in rows)
+
+    def reload(self):
+        with self._lock:
+            self._illust_ids = None
+            self._load()
+
+    def illust_ids(self) -> set:
+        """Returns: a copy of illust ids"""
+        with self._lock:
+            self._load()
+            return set(self._illust_ids)
+
+    def user_ids(self) -> set:
+        """Returns: a copy of ids of users who have illusts"""
+        with self._lock:
+            self._load()
+            return set(self._user_ids)
+
+    def add(self, illust_id, user_id):
+        with self._lock:
+            if self._illust_ids is not None:
+                self._illust_ids.add(int(illust_id))
+                self._user_ids.add(int(user_id))
+
+
+class PyxivSeedSampler:
+    """Sample seeds of crawling from database
+
+    Strategies:
+        "bookmark": weighted by bookmark count among the most bookmarked illusts
+        "stale": never expanded first, then least recently expanded
+        "newest": among the newest illusts
+        "rare_tag": illusts of tags with fewest illusts in database
+
+    Note:
+        Each strategy reads at most about pool rows through indexes, instead of scanning tables.
+    """
+
+    strategies = ["bookmark", "stale", "newest", "rare_tag"]
+
+    def __init__(self, db: PyxivDatabase, seed: int = None):
+        self.db = db
+        self.random = random.Random(seed)
+
+    def _check_strategy(self, strategy):
+        if strategy not in self.strategies:
+            raise ValueError("Incorrect strategy value: {}".format(strategy))
+
+    def _weighted_sample(self, rows, n) -> list:
+        """Weighted reservoir sampling without replacement, rows are (id, weight)"""
+        keys = ((self.random.random() ** (1 / (weight + 1)), id_) for id_, weight in rows)
+        return [id_ for _, id_ in heapq.nlargest(n, keys)]
+
+    def _sample(self, ids, n) -> list:
+        ids = list(dict.fromkeys(ids))
+        return self.random.sample(ids, min(n, len(ids)))
+
+    def _stale_ids(self, kind, n, pool) -> list:
+        kind_value, table, column = self.db.edge_kinds[kind]
+        order = " ORDER BY bookmark_count DESC" if table == "illust" else ""
+        ids = [row[0] for row in self.db(
+            """SELECT "{1}" FROM "{0}" WHERE NOT EXISTS (
+                SELECT 1 FROM edge_fetch WHERE kind = ? AND src = "{0}"."{1}"
+            ){2} LIMIT ?;""".format(table, column, order),
+            (kind_value, pool)
+        )]
+        ids = self._sample(ids, n)
+        if len(ids) < n:
+            ids.extend(row[0] for row in self.db(
+                "SELECT src FROM edge_fetch WHERE kind = ? ORDER BY epoch LIMIT ?;",
+                (kind_value, n - len(ids))
+            ))
+        return ids
+
+    def _rare_tag_illust_ids(self, n, pool) -> list:
+        # count illusts of randomly drawn tags through index, and keep the rarest ones
+        max_tag_id = self.db("SELECT MAX(id) FROM tag_name;")[0][0]
+        if not max_tag_id:
+            return []
+        counts = []
+        for tag_id in set(self.random.randint(1, max_tag_id) for _ in range(min(pool, 8 * n))):
+            count = self.db("SELECT COUNT(*) FROM illust_tag WHERE tag_id = ?;", (tag_id,))[0][0]
+            if count > 0:
+                counts.append((count, tag_id))
+        illust_ids = []
+        for _, tag_id in heapq.nsmallest(n, counts):
+            illust_ids.extend(row[0] for row in self.db(
+                "SELECT illust_id FROM illust_tag WHERE tag_id = ? ORDER BY random() LIMIT 1;", (tag_id,)
+            ))
+        return illust_ids
+
+    def sample_illust_ids(self, n: int, strategy="bookmark", pool: int = 10000) -> list:
+        """Sample illust ids as seeds of crawl_by_illust_recommends
+
+        Args:
+            n: Number of seeds
+            strategy: See strategies of class
+            pool: Max number of candidates read from database
+        """
+        self._check_strategy(strategy)
+        if strategy == "bookmark":
+            return self._weighted_sample(
+                self.db("SELECT id, bookmark_count FROM illust ORDER BY bookmark_count DESC LIMIT ?;", (pool,)), n
+            )
+        elif strategy == "stale":
+            return self._stale_ids("illust_recommend", n, pool)
+        elif strategy == "newest":
+            return self._sample([row[0] for row in self.db("SELECT id FROM illust ORDER BY id DESC LIMIT ?;", (pool,))], n)
+        else:
+            return self._rare_tag_illust_ids(n, pool)
+
+    def sample_user_ids(self, n: int, strategy="bookmark", pool: int = 10000, kind="user_following") -> list:
+        """Sample user ids as seeds of crawl_by_user_*
+
+        Args:
+            kind: "user_following", "user_recommend", how seeds will be expanded, used by "stale"
+            other args: see sample_illust_ids
+        """
+        self._check_strategy(strategy)
+        if strategy == "bookmark":
+            # weight of user is the max bookmark count of its illusts
+            rows = self.db("SELECT user_id, bookmark_count FROM illust ORDER BY bookmark_count DESC LIMIT ?;", (pool,))
+            return self._weighted_sample(dict(reversed(rows)).items(), n)
+        elif strategy == "stale":
+            return self._stale_ids(kind, n, pool)
+        elif strategy == "newest":
+            return self._sample([row[0] for row in self.db("SELECT user_id FROM illust ORDER BY id DESC LIMIT ?;", (pool,))], n)
+        else:
+            illust_ids = self._rare_tag_illust_ids(n, pool)
+            marks = ", ".join("?" * len(illust_ids))
+            return [row[0] for row in self.db("SELECT DISTINCT user_id FROM illust WHERE id IN ({});".format(marks), illust_ids)]
+
+
+class PyxivRateController:
+    """AIMD controller of request rate and concurrency
+
+    Rate and concurrency increase additively after each healthy response,
+    and are cut multiplicatively on 429, 5xx, request errors or latency spikes,
+    never above max_rate and max_concurrency.
+    """
+
+    def __init__(
+            self, max_rate: float = 2.0, max_concurrency: int = 4, initial_rate: float = None,
+            min_rate: float = 0.05, increase: float = 0.02, decrease: float = 0.5, latency_factor: float = 3.0):
+        """
+        Args:
+            max_rate: Hard ceiling of requests per second
+            max_concurrency: Hard ceiling of requests in flight
+            initial_rate: Requests per second at start, default to half of max_rate
+            min_rate: Floor of requests per second
+            increase: Rate and concurrency added after each healthy response
+            decrease: Factor to multiply rate and concurrency by on congestion
+            latency_factor: A response slower than latency_factor times the average latency is a latency spike
+        """
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.logger = logging.getLogger(__name__)
+
+        self.rate = min(initial_rate or max_rate / 2, max_rate)
+        self.concurrency = 1.0
+        self.latencies = {}  # key -> moving average latency of healthy responses
+        self.in_flight = 0
+        self.counts = {"requests": 0, "errors": 0, "throttles": 0, "spikes": 0}
+
+        self._condition = threading.Condition()
+        self._next_time = 0.0
+        self._last_decrease = 0.0
+
+    def acquire(self) -> float:
+        """Block until a request is allowed to start
+
+        Returns:
+            float: Start time of the request, pass to release
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+            now = time()
+            start = max(now, self._next_time)
+            self._next_time = start + 1 / self.rate
+        if start > now:
+            sleep(start - now)
+        return time()
+
+    def release(self, start: float, status_code: int = None, retry_after: str = None, key: str = ""):
+        """Report result of a request started at start
+
+        Args:
+            status_code: status code of response, None means request failed
+            retry_after: Retry-After header of response
+            key: Latency is averaged by key, e.g. host of request, because pages are much slower than ajax
+        """
+        latency = time() - start
+        with self._condition:
+            average = self.latencies.get(key, 0.0)
+            self.in_flight -= 1
+            self.counts["requests"] += 1
+            if status_code is None or status_code == 429 or status_code >= 500:
+                self.counts["errors" if status_code != 429 else "throttles"] += 1
+                self._cut()
+                if retry_after and retry_after.isdigit():
+                    self._next_time = max(self._next_time, time() + int(retry_after))
+            elif average and latency > self.latency_factor * average:
+                self.counts["spikes"] += 1
+                self._cut()
+            else:
+                self.latencies[key] = latency if not average else 0.9 * average + 0.1 * latency
+                self.rate = min(self.max_rate, self.rate + self.increase)
+                self.concurrency = min(self.max_concurrency, self.concurrency + self.increase)
+            self._condition.notify_all()
+
+    def _cut(self):
+        # cut at most once per second, responses of the same burst report the same congestion
+        now = time()
+        if now - self._last_decrease < 1:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.concurrency = max(1.0, self.concurrency * self.decrease)
+        self.logger.info("pixiv:Slow down to {:.2f} requests/s, concurrency {}".format(self.rate, int(self.concurrency)))
+
+    def stats(self) -> dict:
+        """Current rate, concurrency and counters, for monitoring"""
+        with self._condition:
+            return {
+                "rate": self.rate,
+                "concurrency": int(self.concurrency),
+                "in_flight": self.in_flight,
+                "latencies": dict(self.latencies),
+                **self.counts
+            }
+
+
+class PyxivCassette:
+    """Append-only record of requests and responses, to replay a crawl without network
+
+    Each line of cassette file is a json object of one request and its response:
+        {"method", "url", "body_hash", "status", "headers", "body" | "text" | "size", "sha1"}
+    url includes encoded params, body_hash is sha1 of request data or json.
+    Response body is stored as "text" if it is utf8, else as base64 "body",
+    and only "size" and "sha1" are stored for bodies larger than max_body, e.g. pictures.
+    A file with suffix ".gz" is gzip compressed.
+
+    In replay, requests with the same key are served in recorded order, and the last one is repeated when used up.
+    """
+
+    # response headers to keep
+    headers = ["Content-Type", "Content-Length", "Retry-After", "Location"]
+
+    def __init__(self, path, mode="replay", max_body: int = 2**20):
+        """
+        Args:
+            mode: "record" | "replay"
+            max_body: Max bytes of a response body to store, -1 for no limit
+        """
+        if mode not in ("record", "replay"):
+            raise ValueError("Incorrect mode value: {}".format(mode))
+        self.path = Path(path)
+        self.mode = mode
+        self.max_body = max_body
+        self.logger = logging.getLogger(__name__)
+        self.counts = {"recorded": 0, "replayed": 0, "missed": 0}
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> deque of entries
+        self._last = {}  # key -> last replayed entry
+        self._file = None
+
+        if mode == "replay":
+            for entry in self._iter_entries():
+                self._entries.setdefault(self._key_of(entry), deque()).append(entry)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            opener = gzip.open if self.path.suffix == ".gz" else open
+            self._file = opener(self.path, "at", encoding="utf8")
+            atexit.register(self.close)
+
+    def _iter_entries(self):
+        opener = gzip.open if self.path.suffix == ".gz" else open
+        with opener(self.path, "rt", encoding="utf8") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            except (EOFError, json.JSONDecodeError):
+                # last line of an interrupted recording
+                self.logger.warning("Cassette:Truncated file {}".format(self.path))
+
+    @staticmethod
+    def _key_of(entry) -> tuple:
+        return (entry["method"], entry["url"], entry["body_hash"])
+
+    @staticmethod
+    def request_key(method, url, **kwargs) -> tuple:
+        """Key of a request by arguments of requests.Session.request, Host header replaces ip in url"""
+        host = (kwargs.get("headers") or {}).get("Host")
+        if host:
+            url = urlparse(url)._replace(netloc=host).geturl()
+        url = requests.Request(method.upper(), url, params=kwargs.get("params")).prepare().url
+        body = kwargs.get("data") if kwargs.get("data") is not None else kwargs.get("json")
+        body_hash = hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest() if body is not None else ""
+        return (method.upper(), url, body_hash)
+
+    def record(self, key: tuple, response: requests.Response):
+        content = response.content or b""
+        entry = {
+            "method": key[0], "url": key[1], "body_hash": key[2],
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in self.headers if name in response.headers},
+            "sha1": hashlib.sha1(content).hexdigest(),
+        }
+        if 0 <= self.max_body < len(content):
+            entry["size"] = len(content)
+        else:
+            try:
+                entry["text"] = content.decode("utf8")
+            except UnicodeDecodeError:
+                entry["body"] = base64.b64encode(content).decode("ascii")
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.counts["recorded"] += 1
+
+    def replay(self, key: tuple) -> requests.Response:
+        """Returns: Recorded response of key, an empty requests.Response if not recorded"""
+        with self._lock:
+            entries = self._entries.get(key)
+            entry = entries.popleft() if entries else self._last.get(key)
+            if entry is None:
+                self.counts["missed"] += 1
+                self.logger.warning("Cassette:Not recorded:{}".format(key))
+                return requests.Response()
+            self._last[key] = entry
+            self.counts["replayed"] += 1
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers.update(entry["headers"])
+        response.url = entry["url"]
+        if "text" in entry:
+            response._content = entry["text"].encode("utf8")
+            response.encoding = "utf8"
+        elif "body" in entry:
+            response._content = base64.b64decode(entry["body"])
+        else:
+            # body not stored, keep its size for downstream work
+            response._content = bytes(entry["size"])
+        return response
+
+    def close(self):
+        if self._file:
+            with self._lock:
+                self._file.close()
+                self._file = None
+
+
+# counter of requests of the current call, copied into worker threads of the call
+_request_counter = contextvars.ContextVar("request_counter", default=None)
+
+
+class PyxivRequestCounter:
+    """Count requests of PyxivBrowser made in a with block, by the current thread and worker threads copying its context
+
+    Unlike counts of PyxivRateController, which are shared by all calls, concurrent calls count separately,
+    and requests replayed from cassette are counted too.
+
+    Example:
+        with PyxivRequestCounter() as counter:
+            browser.get_illust(illust_id)
+        print(counter.count)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+
+    def __enter__(self) -> "PyxivRequestCounter":
+        self._token = _request_counter.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _request_counter.reset(self._token)
 
 
 class PyxivBrowser(requests.Session):
@@ -199,14 +2066,24 @@ class PyxivBrowser(requests.Session):
     php_rpc_recommender = "https://www.pixiv.net/rpc/recommender.php"  # ?type=illust&sample_illusts=88548686&num_recommendations=500
     php_bookmark_add = "https://www.pixiv.net/bookmark_add.php"  # mode:"add" type:"user" user_id:"" tag:"" restrict:"" format:"json"
 
-    def __init__(self, proxies: dict = None, cookies: dict = None, interval: float = 0.01) -> None:
+    def __init__(self, proxies: dict = None, cookies: dict = None, interval: float = 0.5, rate_limit: dict = None, cassette: dict = None) -> None:
         """
         Args:
-            interval: Seconds between each request. Default to 0.1
+            interval: Seconds between each request at start, then adjusted by rate_controller. Default to 0.5
+            rate_limit: Arguments of PyxivRateController, like {"max_rate": 2.0, "max_concurrency": 4}
+            cassette: Arguments of PyxivCassette, like {"path": "./cassette.jsonl.gz", "mode": "record"},
+                in "replay" mode all requests are served from cassette without network and rate limit
         """
         super().__init__()
-        self.interval = interval or 0.01
+        self.interval = interval or 0.5
         self.logger = logging.getLogger(__name__)
+        self.rate_controller = PyxivRateController(**{"initial_rate": 1 / self.interval, **(rate_limit or {})})
+        self.cassette = PyxivCassette(**cassette) if cassette else None
+
+        # concurrent calls of the same get_* share one request
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self.flight_counts = {"calls": 0, "coalesced": 0}
 
         if proxies:
             self.proxies.update(proxies)
@@ -218,22 +2095,45 @@ class PyxivBrowser(requests.Session):
 
     @wrapper.requests_alter()
     def request(self, method, url, *args, **kwargs) -> requests.Response:
+        counter = _request_counter.get()
+        if counter is not None:
+            counter.add()
+        if self.cassette:
+            key = self.cassette.request_key(method, url, **kwargs)
+            if self.cassette.mode == "replay":
+                return self.cassette.replay(key)
+
+        # url may have been altered to ip, average latency by the original host
+        host = (kwargs.get("headers") or {}).get("Host") or urlparse(url).netloc
+        with pyxivtrace.span("rate_wait"):
+            start = self.rate_controller.acquire()
+        response = None
         try:
-            sleep(self.interval + random.random())
-            return super().request(method, url, *args, **kwargs)
+            with pyxivtrace.span("http", method=method, url=url):
+                response = super().request(method, url, *args, **kwargs)
+            if self.cassette:
+                self.cassette.record(key, response)
+            return response
         except Exception as e:
             self.logger.error("{}:{}".format(url, e))
             return requests.Response()
+        finally:
+            if response is None:
+                self.rate_controller.release(start, key=host)
+            else:
+                self.rate_controller.release(start, response.status_code, response.headers.get("Retry-After"), host)
 
     def _get_csrf_token(self) -> str:
         """Get x-csrf-token"""
         html = self.get(self.url_host).text
-        soup = bs4.BeautifulSoup(html, "lxml")
-        token = json.loads(soup.find("meta", {"id": "meta-global-data"}).attrs.get("content", "{}")).get("token", "")
+        with pyxivtrace.span("html_parse"):
+            soup = bs4.BeautifulSoup(html, "lxml")
+            token = json.loads(soup.find("meta", {"id": "meta-global-data"}).attrs.get("content", "{}")).get("token", "")
         return token
 
     # GET method
 
+    @wrapper.singleflight()
     @wrapper.empty_retry()
     def get_page(self, page_url) -> bytes:
         response = self.get(page_url)
@@ -242,6 +2142,18 @@ class PyxivBrowser(requests.Session):
             return b""
         return response.content
 
+    def get_page_size(self, page_url) -> int:
+        """Get byte size of a page by HEAD request
+
+        Returns:
+            Content-Length of the page, -1 if unknown
+        """
+        response = self.head(page_url)
+        if response.status_code != 200:
+            return -1
+        return int(response.headers.get("Content-Length", -1))
+
+    @pyxivtrace.traced()
     @wrapper.cookies_required()
     def get_top_illust(self, mode="all") -> dict:
         """Get top illusts by mode
@@ -252,6 +2164,7 @@ class PyxivBrowser(requests.Session):
         json_ = self.get(self.ajax_top_illust, params={"mode": mode}).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     def get_search_artworks(self, keyword, order="date_d", mode="all", p=1, s_mode="s_tag", type_="all") -> dict:
         """Get search artworks result
 
@@ -273,6 +2186,7 @@ class PyxivBrowser(requests.Session):
             }).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     def get_search_illustrations(self, keyword, order="date_d", mode="all", p=1, s_mode="s_tag", type_="illust") -> dict:
         """Get search illustration or ugoira result
 
@@ -294,6 +2208,7 @@ class PyxivBrowser(requests.Session):
             }).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     def get_search_manga(self, keyword, order="date_d", mode="all", p=1, s_mode="s_tag", type_="manga") -> dict:
         """Get search manga result
 
@@ -315,14 +2230,19 @@ class PyxivBrowser(requests.Session):
             }).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
+    @wrapper.singleflight()
     def get_illust(self, illust_id) -> dict:
         json_ = self.get(self.ajax_illust.format(illust_id=illust_id)).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
+    @wrapper.singleflight()
     def get_illust_pages(self, illust_id) -> list:
         json_ = self.get(self.ajax_illust_pages.format(illust_id=illust_id)).json()
         return [] if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     def get_illust_recommend_init(self, illust_id, limit=1) -> dict:
         """details.keys()"""
         json_ = self.get(
@@ -331,10 +2251,12 @@ class PyxivBrowser(requests.Session):
         ).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     def get_user(self, user_id) -> dict:
         json_ = self.get(self.ajax_user.format(user_id=user_id)).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     @wrapper.cookies_required()
     def get_user_following(self, user_id, offset, limit=50, rest="show") -> dict:
         """Get following list of a user
@@ -353,6 +2275,7 @@ class PyxivBrowser(requests.Session):
         ).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     @wrapper.cookies_required()
     def get_user_recommends(self, user_id, userNum=100, workNum=3, isR18=True) -> dict:
         """Get recommends of a user
@@ -371,14 +2294,18 @@ class PyxivBrowser(requests.Session):
         ).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
+    @wrapper.singleflight()
     def get_user_profile_all(self, user_id) -> dict:
         json_ = self.get(self.ajax_user_profile_all.format(user_id=user_id)).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     def get_user_profile_top(self, user_id) -> dict:
         json_ = self.get(self.ajax_user_profile_top.format(user_id=user_id)).json()
         return {} if json_["error"] is True else json_["body"]
 
+    @pyxivtrace.traced()
     def get_ranking(self, p=1, content="all", mode="daily", date: str = None) -> dict:
         """Get ranking, limit 50 illusts info in one page
 
@@ -401,6 +2328,7 @@ class PyxivBrowser(requests.Session):
         ).json()
         return {} if "error" in json_ else json_
 
+    @pyxivtrace.traced()
     @wrapper.cookies_required()
     def get_rpc_recommender(self, sample_illusts: int, num_recommendations=500, type_="illust") -> list:
         """Deprecated, used to get recommended illust ids
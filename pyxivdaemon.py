@@ -0,0 +1,360 @@
+import contextvars
+import hmac
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from collections import deque
+
+from pyxiv import PyxivSpider
+from pyxivbase import PyxivIdIndex
+
+
+# log of the job running in current context, copied into worker threads of the job
+_job_log = contextvars.ContextVar("job_log", default=None)
+
+
+class _JobOutput(io.TextIOBase):
+    """Replace sys.stdout, route prints of job threads to logs of their jobs"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, s):
+        log = _job_log.get()
+        if log is None:
+            return self.stream.write(s)
+        log.write(s)
+        return len(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class PyxivJobLog:
+    """Output of a running job, lines can be followed by clients"""
+
+    def __init__(self, max_lines: int = 10000):
+        self.lines = deque(maxlen=max_lines)
+        self.count = 0  # number of lines ever written
+        self.finished = False
+        self._buffer = ""
+        self._condition = threading.Condition()
+
+    def write(self, s):
+        with self._condition:
+            self._buffer += s
+            # progress lines end with "\r"
+            *lines, self._buffer = self._buffer.replace("\r", "\n").split("\n")
+            lines = [line for line in lines if line]
+            self.lines.extend(lines)
+            self.count += len(lines)
+            if lines:
+                self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            if self._buffer:
+                self.lines.append(self._buffer)
+                self.count += 1
+                self._buffer = ""
+            self.finished = True
+            self._condition.notify_all()
+
+    def follow(self, timeout: float = 1.0):
+        """Yield lines until finished, earlier lines beyond max_lines are lost"""
+        sent = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.count > sent or self.finished, timeout)
+                start = max(sent, self.count - len(self.lines))
+                lines = list(self.lines)[start - (self.count - len(self.lines)):]
+                sent = self.count
+                finished = self.finished
+            yield from lines
+            if finished:
+                return
+
+
+class PyxivDaemon:
+    """Keep one PyxivSpider warm, and run jobs submitted from a local socket
+
+    Jobs are persisted in job table of database, run in order of priority, then submission,
+    with at most concurrency[kind] jobs of each kind at the same time. Jobs interrupted by a restart are queued again.
+
+    Protocol:
+        One json object per line for each request and response.
+        Each request carries {"token"} if token is set in daemon of config, which is required for tcp.
+        {"op": "submit", "method": "download_user", "args": [...], "kwargs": {...}, "priority": 0} -> {"job_id"}
+        {"op": "status", "job_id"} -> {"job"}
+        {"op": "list", "states": ["queued", "running"], "limit": 100} -> {"jobs"}
+        {"op": "cancel", "job_id"} -> {"cancelled"}, only queued jobs can be cancelled
+        {"op": "follow", "job_id"} -> {"log"} for each line of output, then {"job"} when finished
+        {"op": "stats"} -> {"running", "rate_controller", "flight_counts"}
+        Errors are returned as {"error"}.
+    """
+
+    # method prefix -> kind of job
+    kinds = {
+        "crawl_": "crawl",
+        "download_": "download",
+        "update_": "update",
+        "save_": "update",
+        "backfill_": "update",
+        "search_cache": "search",
+    }
+
+    default_concurrency = {"crawl": 1, "download": 2, "update": 1, "search": 4}
+
+    loopback_hosts = ["", "127.0.0.1", "localhost", "::1", "[::1]"]
+
+    def __init__(self, config_path, address=None, concurrency: dict = None):
+        """
+        Args:
+            address: Path of unix socket, or "host:port" for tcp on platforms without unix socket,
+                default to address in daemon of config, or "./pyxiv.sock".
+                Tcp only listens on loopback hosts, and requires token in daemon of config
+            concurrency: Max running jobs of each kind, like {"crawl": 1, "download": 2, "update": 1, "search": 4}
+        """
+        self.spider = PyxivSpider(config_path)
+        self.db = self.spider.db
+        # crawl jobs share ids in memory, updated when illusts are saved
+        self.spider.id_index = PyxivIdIndex(self.db)
+        config = self.spider.config.daemon or {}
+        self.address = address or config.get("address") or "./pyxiv.sock"
+        self.token = config.get("token")
+        self.concurrency = {**self.default_concurrency, **config.get("concurrency", {}), **(concurrency or {})}
+        self.logger = logging.getLogger(__name__)
+
+        self.running = {}  # job_id -> (kind, log)
+        self._condition = threading.Condition()
+        self._stop = False
+        self._server = None
+
+        requeued = self.db.requeue_jobs().result()
+        if requeued:
+            print("Requeued {} interrupted jobs".format(requeued))
+
+    @classmethod
+    def kind_of(cls, method) -> str:
+        for prefix, kind in cls.kinds.items():
+            if method.startswith(prefix):
+                return kind
+        return None
+
+    def submit(self, method, args: list = None, kwargs: dict = None, priority: int = 0) -> int:
+        kind = self.kind_of(method)
+        if not kind or not callable(getattr(self.spider, method, None)):
+            raise ValueError("Incorrect method value: {}".format(method))
+        job_id = self.db.insert_job(method, json.dumps(args or []), json.dumps(kwargs or {}), kind, priority).result()
+        with self._condition:
+            self._condition.notify_all()
+        return job_id
+
+    def _dispatch(self):
+        """Start queued jobs when their kinds have free slots"""
+        while True:
+            with self._condition:
+                if self._stop:
+                    return
+                counts = {}
+                for kind, _ in self.running.values():
+                    counts[kind] = counts.get(kind, 0) + 1
+                full = [kind for kind, limit in self.concurrency.items() if counts.get(kind, 0) >= limit]
+                job = self.db.get_next_job(full)
+                if job is None:
+                    self._condition.wait()
+                    continue
+            # write state without holding the lock, handlers would wait behind the writer queue,
+            # only this thread starts jobs, and a job cancelled meanwhile is not set running
+            if not self.db.set_job_state(job["id"], "running").result():
+                continue
+            log = PyxivJobLog()
+            with self._condition:
+                self.running[job["id"]] = (job["kind"], log)
+                self._condition.notify_all()
+            threading.Thread(target=self._run, args=(job, log), name="PyxivJob-{}".format(job["id"]), daemon=True).start()
+
+    def _run(self, job, log: PyxivJobLog):
+        _job_log.set(log)
+        try:
+            result = getattr(self.spider, job["method"])(*json.loads(job["args"]), **json.loads(job["kwargs"]))
+            self.db.set_job_state(job["id"], "done", json.dumps(result, ensure_ascii=False, default=str)).result()
+        except Exception as e:
+            log.write(traceback.format_exc())
+            self.db.set_job_state(job["id"], "failed", error="{}: {}".format(type(e).__name__, e)).result()
+        finally:
+            _job_log.set(None)
+            log.finish()
+            with self._condition:
+                self.running.pop(job["id"], None)
+                self._condition.notify_all()
+
+    def handle(self, request: dict, send):
+        """Handle a request, send(dict) responses"""
+        if self.token and not hmac.compare_digest(str(request.get("token", "")).encode("utf8"), self.token.encode("utf8")):
+            raise PermissionError("Incorrect token")
+        op = request.get("op")
+        if op == "submit":
+            send({"job_id": self.submit(request["method"], request.get("args"), request.get("kwargs"), request.get("priority", 0))})
+        elif op == "status":
+            send({"job": self.db.get_job(request["job_id"])})
+        elif op == "list":
+            send({"jobs": self.db.get_jobs(request.get("states"), request.get("limit", 100))})
+        elif op == "cancel":
+            cancelled = self.db.cancel_job(request["job_id"]).result()
+            with self._condition:
+                self._condition.notify_all()
+            send({"cancelled": cancelled})
+        elif op == "follow":
+            job_id = request["job_id"]
+            # wait for a queued job to start
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: job_id in self.running or self.db.get_job(job_id).get("state") not in ("queued", "running")
+                )
+                running = self.running.get(job_id)
+            if running:
+                for line in running[1].follow():
+                    send({"log": line})
+            send({"job": self.db.get_job(job_id)})
+        elif op == "stats":
+            send({
+                "running": {job_id: kind for job_id, (kind, _) in self.running.items()},
+                "rate_controller": self.spider.browser.rate_controller.stats(),
+                "flight_counts": self.spider.browser.flight_counts,
+            })
+        else:
+            raise ValueError("Incorrect op value: {}".format(op))
+
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                def send(response):
+                    self.wfile.write((json.dumps(response, ensure_ascii=False, default=str) + "\n").encode("utf8"))
+                    self.wfile.flush()
+
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        daemon.handle(json.loads(line), send)
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+                    except Exception as e:
+                        send({"error": "{}: {}".format(type(e).__name__, e)})
+
+        host, _, port = str(self.address).rpartition(":")
+        if port.isdigit():
+            # tcp can be reached by other local users, so requests must carry the token
+            if host not in self.loopback_hosts:
+                raise ValueError("Incorrect address value: {}, only loopback hosts are allowed".format(self.address))
+            if not self.token:
+                raise ValueError("token in daemon of config is required for tcp address: {}".format(self.address))
+            server_class = type("Server", (socketserver.ThreadingMixIn, socketserver.TCPServer), {"daemon_threads": True})
+            if host.strip("[]") == "::1":
+                server_class.address_family = socket.AF_INET6
+            self._server = server_class((host.strip("[]") or "127.0.0.1", int(port)), Handler)
+        else:
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            server_class = type("Server", (socketserver.ThreadingMixIn, socketserver.UnixStreamServer), {"daemon_threads": True})
+            self._server = server_class(self.address, Handler, bind_and_activate=False)
+            try:
+                self._server.server_bind()
+                # only the owner can connect, set before listening
+                os.chmod(self.address, 0o600)
+                self._server.server_activate()
+            except OSError:
+                self._server.server_close()
+                raise
+
+        sys.stdout = _JobOutput(sys.stdout)
+        threading.Thread(target=self._dispatch, name="PyxivDispatcher", daemon=True).start()
+        print("Listening on {}".format(self.address))
+        try:
+            self._server.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        if self._server:
+            self._server.server_close()
+            if not str(self.address).rpartition(":")[2].isdigit() and os.path.exists(self.address):
+                os.remove(self.address)
+        if isinstance(sys.stdout, _JobOutput):
+            sys.stdout = sys.stdout.stream
+
+
+class PyxivClient:
+    """Thin client of PyxivDaemon"""
+
+    def __init__(self, address="./pyxiv.sock", token: str = None):
+        """
+        Args:
+            token: token in daemon of config, sent with each request
+        """
+        self.address = address
+        self.token = token
+
+    def _connect(self) -> socket.socket:
+        host, _, port = str(self.address).rpartition(":")
+        if port.isdigit():
+            return socket.create_connection((host.strip("[]") or "127.0.0.1", int(port)))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        return sock
+
+    def request(self, request: dict):
+        """Send a request, yield responses until the daemon finishes it"""
+        if self.token:
+            request = {**request, "token": self.token}
+        with self._connect() as sock:
+            sock.sendall((json.dumps(request) + "\n").encode("utf8"))
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile("r", encoding="utf8") as f:
+                for line in f:
+                    response = json.loads(line)
+                    if "error" in response:
+                        raise RuntimeError(response["error"])
+                    yield response
+
+    def _call(self, request: dict) -> dict:
+        return next(self.request(request))
+
+    def submit(self, method, *args, priority: int = 0, **kwargs) -> int:
+        return self._call({"op": "submit", "method": method, "args": args, "kwargs": kwargs, "priority": priority})["job_id"]
+
+    def status(self, job_id) -> dict:
+        return self._call({"op": "status", "job_id": job_id})["job"]
+
+    def list(self, states: list = None, limit: int = 100) -> list:
+        return self._call({"op": "list", "states": states, "limit": limit})["jobs"]
+
+    def cancel(self, job_id) -> bool:
+        return self._call({"op": "cancel", "job_id": job_id})["cancelled"]
+
+    def stats(self) -> dict:
+        return self._call({"op": "stats"})
+
+    def follow(self, job_id):
+        """Yield output lines of a job until it finishes
+
+        Returns:
+            dict: the finished job, as value of StopIteration
+        """
+        for response in self.request({"op": "follow", "job_id": job_id}):
+            if "log" in response:
+                yield response["log"]
+            else:
+                return response["job"]
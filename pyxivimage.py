@@ -0,0 +1,254 @@
+import logging
+import os
+import struct
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def image_info(data: bytes) -> tuple:
+    """Read format, width and height from header of an image, without decoding it
+
+    Returns:
+        tuple: (format, width, height), format is "jpeg", "png", "gif", "webp" or "", width and height are 0 if unknown
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return ("png", *struct.unpack(">II", data[16:24]))
+    if data[:4] == b"GIF8" and len(data) >= 10:
+        return ("gif", *struct.unpack("<HH", data[6:10]))
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8X":
+            return ("webp", int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1)
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return ("webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return ("webp", width & 0x3FFF, height & 0x3FFF)
+        return ("webp", 0, 0)
+    if data[:2] == b"\xff\xd8":
+        # walk segments until a start of frame marker
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                break
+            marker = data[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            length = struct.unpack(">H", data[i + 2:i + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return ("jpeg", width, height)
+            i += 2 + length
+        return ("jpeg", 0, 0)
+    return ("", 0, 0)
+
+
+def dhash(data: bytes, hash_size: int = 8) -> int:
+    """Difference hash of an image, similar images have hashes of small Hamming distance
+
+    Returns:
+        int: Unsigned hash of hash_size * hash_size bits, None if Pillow is not installed
+    """
+    if not Image:
+        return None
+    with Image.open(BytesIO(data)) as image:
+        image = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+        pixels = list(image.getdata())
+    hash_ = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            i = row * (hash_size + 1) + col
+            hash_ = (hash_ << 1) | (pixels[i] > pixels[i + 1])
+    return hash_
+
+
+def _thumbnail(image, thumb_path: Path, max_side: int, format_: str, frames: list = None, frame_delay: int = 100):
+    image.thumbnail((max_side, max_side))
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    thumb_path.parent.mkdir(parents=True, exist_ok=True)
+    if frames:
+        for frame in frames:
+            frame.thumbnail((max_side, max_side))
+        frames = [frame if frame.mode in ("RGB", "RGBA") else frame.convert("RGB") for frame in frames]
+        image.save(thumb_path, format_, save_all=True, append_images=frames, duration=frame_delay, loop=0)
+    else:
+        image.save(thumb_path, format_)
+
+
+def process_file(path, thumb_path=None, max_side: int = 512, format_: str = "WEBP", frame_delay: int = 100) -> dict:
+    """Read metadata of a downloaded page and make its thumbnail, run in worker processes
+
+    Args:
+        path: Picture, or zip archive of ugoira frames
+        thumb_path: Path of thumbnail, None for no thumbnail, ignored if Pillow is not installed
+        max_side: Max width and height of thumbnail
+        format_: Format of thumbnail for Pillow, ugoira frames are made into an animated thumbnail
+        frame_delay: Milliseconds of each frame of animated thumbnail
+
+    Returns:
+        dict: {"format", "width", "height", "bytes", "frames", "thumb_path"}
+    """
+    path = Path(path)
+    data = path.read_bytes()
+    info = {"bytes": len(data), "frames": 1, "thumb_path": ""}
+    frames = None
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = sorted(name for name in archive.namelist() if not name.endswith("/"))
+            info["frames"] = len(names)
+            first = archive.read(names[0]) if names else b""
+            if thumb_path and Image and len(names) > 1:
+                frames = [Image.open(BytesIO(archive.read(name))) for name in names[1:]]
+        format_name, width, height = image_info(first)
+        info["format"] = "ugoira_" + format_name if format_name else "ugoira"
+        data = first
+    else:
+        format_name, width, height = image_info(data)
+        info["format"] = format_name
+
+    if Image and data and (not width or thumb_path):
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+            info["format"] = info["format"] or image.format.lower()
+            if thumb_path:
+                _thumbnail(image, Path(thumb_path), max_side, format_, frames, frame_delay)
+                info["thumb_path"] = str(thumb_path)
+    info["width"], info["height"] = width, height
+    return info
+
+
+class PyxivImageProcessor:
+    """Post-process downloaded pages in worker processes, and store their metadata in page_file table
+
+    Downloads only submit paths, and never wait for CPU work. A page submitted when queue_size pages are pending
+    is recorded as pending in page_file, with bytes 0, and is processed by submit_pending after downloads.
+    A page which fails to be processed is also left pending, and retried until max_attempts.
+
+    Note:
+        Thumbnails need Pillow, without it only metadata readable from file headers is stored.
+    """
+
+    def __init__(
+            self, db, workers: int = None, queue_size: int = 64, max_attempts: int = 3, thumb_dir=None,
+            thumb_max_side: int = 512, thumb_format: str = "webp", frame_delay: int = 100):
+        """
+        Args:
+            db: PyxivDatabase to store metadata
+            workers: Number of worker processes, default to number of CPUs
+            queue_size: Max number of pages pending or being processed
+            max_attempts: Max number of failed processing of a page, before it is no longer retried
+            thumb_dir: Dir to save thumbnails, None for no thumbnails
+            thumb_max_side, thumb_format, frame_delay: see process_file
+        """
+        self.db = db
+        self.max_attempts = max_attempts
+        self.thumb_dir = thumb_dir
+        self.thumb_max_side = thumb_max_side
+        self.thumb_format = thumb_format
+        self.frame_delay = frame_delay
+        self.logger = logging.getLogger(__name__)
+        self.counts = {"submitted": 0, "processed": 0, "skipped": 0, "errors": 0}
+
+        self._executor = ProcessPoolExecutor(workers or os.cpu_count())
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+
+        if thumb_dir and not Image:
+            self.logger.warning("Pillow not found, thumbnails are disabled, install it by: pip install Pillow")
+
+    def submit(self, illust_id, page_id, size, path) -> bool:
+        """Process a downloaded page in background, without blocking
+
+        Args:
+            size: size of the page, a value of PyxivSpider.page_sizes
+
+        Returns:
+            bool: False if recorded as pending because the queue is full
+        """
+        return self._submit(illust_id, page_id, size, path, 0, False)
+
+    def _submit(self, illust_id, page_id, size, path, attempts: int, blocking: bool) -> bool:
+        if not self._slots.acquire(blocking):
+            self.db.insert_page_file(illust_id, page_id, size, str(path), "", 0, 0, 0, 1, "", attempts).result()
+            with self._lock:
+                self.counts["skipped"] += 1
+            return False
+
+        thumb_path = None
+        if self.thumb_dir and Image:
+            thumb_path = Path(self.thumb_dir, "{}_p{}_{}.{}".format(illust_id, page_id, size, self.thumb_format.lower()))
+        with self._lock:
+            self.counts["submitted"] += 1
+            self._pending += 1
+        try:
+            future = self._executor.submit(
+                process_file, str(path), thumb_path, self.thumb_max_side, self.thumb_format, self.frame_delay
+            )
+        except Exception:
+            self._done()
+            raise
+        future.add_done_callback(lambda future: self._store(future, illust_id, page_id, size, path, attempts))
+        return True
+
+    def submit_pending(self) -> int:
+        """Submit pages recorded as pending, excluding pages failed max_attempts times, block when the queue is full
+
+        Returns:
+            int: Number of pages submitted
+        """
+        rows = self.db(
+            "SELECT illust_id, page_id, size, path, attempts FROM page_file WHERE bytes = 0 AND attempts < ?;",
+            (self.max_attempts,)
+        )
+        return sum(self._submit(*row, True) for row in rows)
+
+    def _store(self, future, illust_id, page_id, size, path, attempts):
+        try:
+            info = future.result()
+            self.db.insert_page_file(
+                illust_id, page_id, size, str(path),
+                info["format"], info["width"], info["height"], info["bytes"], info["frames"], info["thumb_path"]
+            ).result()
+            key = "processed"
+        except Exception as e:
+            self.logger.error("ImageProcessor:{}:{}".format(path, e))
+            key = "errors"
+            # keep the page pending, and count the failure
+            try:
+                self.db.insert_page_file(
+                    illust_id, page_id, size, str(path), "", 0, 0, 0, 1, "", attempts + 1, "{}: {}".format(type(e).__name__, e)
+                ).result()
+            except Exception as e:
+                self.logger.error("ImageProcessor:{}:{}".format(path, e))
+        with self._lock:
+            self.counts[key] += 1
+        self._done()
+
+    def _done(self):
+        self._slots.release()
+        with self._lock:
+            self._pending -= 1
+            if not self._pending:
+                self._idle.notify_all()
+
+    def wait(self):
+        """Block until all submitted pages are processed"""
+        with self._lock:
+            self._idle.wait_for(lambda: not self._pending)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
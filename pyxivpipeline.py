@@ -0,0 +1,159 @@
+import contextvars
+import logging
+import queue
+import threading
+from time import perf_counter
+
+
+class PyxivStage:
+    """A stage of PyxivPipeline"""
+
+    def __init__(self, name, func, workers: int = 1, expand: bool = False):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.expand = expand
+        self.counts = {"in": 0, "out": 0, "dropped": 0, "errors": 0}
+        self.busy = 0.0  # seconds spent in func by all workers
+        self.lock = threading.Lock()
+
+
+class PyxivPipeline:
+    """Run items through stages connected by bounded queues
+
+    Each stage has its own worker threads. func of a stage takes an item and returns the item for next stage,
+    or None to drop it, or an iterable of items if the stage expands, which can be a generator to pass items
+    on while listing them. A full queue blocks the stage before it,
+    so a slow stage holds back the faster ones instead of buffering without limit.
+
+    Example:
+        pipeline = PyxivPipeline().add_stage("resolve", resolve, 4).add_stage("download", download, 4)
+        results = pipeline.run(illust_ids)
+        print(pipeline.report())
+    """
+
+    _stop = object()
+
+    def __init__(self, queue_size: int = 32):
+        """
+        Args:
+            queue_size: Max items waiting between two stages
+        """
+        self.queue_size = queue_size
+        self.stages = []
+        self.elapsed = 0.0
+        self.logger = logging.getLogger(__name__)
+
+    def add_stage(self, name, func, workers: int = 1, expand: bool = False) -> "PyxivPipeline":
+        self.stages.append(PyxivStage(name, func, workers, expand))
+        return self
+
+    def _feed(self, items, output: queue.Queue, next_stage: PyxivStage):
+        try:
+            for item in items:
+                output.put(item)
+        except Exception as e:
+            self.logger.error("Pipeline:listing:{}".format(e))
+        finally:
+            for _ in range(next_stage.workers):
+                output.put(self._stop)
+
+    def _work(self, stage: PyxivStage, input_: queue.Queue, output: queue.Queue, next_stage: PyxivStage, results: list, remaining: list):
+        while True:
+            item = input_.get()
+            if item is self._stop:
+                break
+
+            busy = 0.0
+            outputs = 0
+            error = False
+            start = perf_counter()
+            try:
+                result = stage.func(item)
+                if result is not None:
+                    # outputs of an expanding stage are passed on as they are produced,
+                    # time blocked by the next stage is not busy time
+                    for result in (result if stage.expand else [result]):
+                        busy += perf_counter() - start
+                        if next_stage:
+                            output.put(result)
+                        else:
+                            results.append(result)
+                        outputs += 1
+                        start = perf_counter()
+            except Exception as e:
+                self.logger.error("Pipeline:{}:{}:{}".format(stage.name, item, e))
+                error = True
+            busy += perf_counter() - start
+            with stage.lock:
+                stage.busy += busy
+                stage.counts["in"] += 1
+                stage.counts["out"] += outputs
+                if error:
+                    stage.counts["errors"] += 1
+                elif not outputs:
+                    stage.counts["dropped"] += 1
+
+        # the last worker of a stage stops the next stage
+        with stage.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and next_stage:
+            for _ in range(next_stage.workers):
+                output.put(self._stop)
+
+    def run(self, items) -> list:
+        """Run all items through stages, block until finished
+
+        Args:
+            items: An iterable of input items, can be a generator which lists items lazily
+
+        Returns:
+            list: Outputs of the last stage, not in input order
+        """
+        if not self.stages:
+            return list(items)
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        results = []
+        # threads run in copies of context of caller, e.g. log of a daemon job
+        threads = [threading.Thread(
+            target=contextvars.copy_context().run, args=(self._feed, items, queues[0], self.stages[0]), daemon=True
+        )]
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            output = queues[i + 1] if next_stage else None
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(self._work, stage, queues[i], output, next_stage, results, remaining), daemon=True
+                ))
+
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = perf_counter() - start
+        return results
+
+    def stats(self) -> dict:
+        """Counts, busy seconds and throughput of each stage in the last run"""
+        stats = {}
+        for stage in self.stages:
+            with stage.lock:
+                stats[stage.name] = {
+                    **stage.counts,
+                    "workers": stage.workers,
+                    "busy": stage.busy,
+                    "throughput": stage.counts["in"] / self.elapsed if self.elapsed else 0.0,
+                }
+        return stats
+
+    def report(self) -> str:
+        lines = ["Pipeline: {:.1f}s".format(self.elapsed)]
+        for name, stats in self.stats().items():
+            lines.append(
+                "  {}: {in} in, {out} out, {errors} errors, {workers} workers, {busy:.1f}s busy, {throughput:.2f} items/s".format(name, **stats)
+            )
+        return "\n".join(lines)
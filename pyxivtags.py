@@ -0,0 +1,207 @@
+import threading
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = None
+    scipy = None
+
+
+class PyxivTagAnalytics:
+    """Tag co-occurrence analytics over illust_tag of a PyxivDatabase, in sparse matrices
+
+    A is the illust x tag incidence matrix, C = A.T @ A is the tag x tag co-occurrence matrix,
+    whose diagonal is the number of illusts of each tag.
+    refresh() reads only illust_tag rows newer than the last refresh, by PyxivDatabase.iter_illust_tags, and updates
+    C += A.T @ D + D.T @ A + D.T @ D with the new rows D, instead of rebuilding from scratch.
+    Bookmarks are read for new illusts of A, and for illusts updated since the last refresh.
+    Results are cached until refresh() finds new rows.
+
+    Note:
+        Requires numpy and scipy. Matrices are rebuilt when shards of the database change.
+    """
+
+    def __init__(self, db, auto_refresh: bool = True):
+        """
+        Args:
+            db: PyxivDatabase
+            auto_refresh: Refresh before each query, costs one query of generation when nothing changed
+        """
+        if scipy is None:
+            raise ImportError("PyxivTagAnalytics requires numpy and scipy, install them by: pip install numpy scipy")
+        self.db = db
+        self.auto_refresh = auto_refresh
+        self._lock = threading.RLock()
+        self._position = {}  # position of db.iter_illust_tags
+        self._reset()
+
+    def _reset(self):
+        self._generation = None
+        self._bookmark_since = ""  # max last_update_date of illusts read
+        self._unknown_bookmarks = set()  # illusts of A not found in illust table yet
+        self._rows = {}  # illust_id -> row of A
+        self._names = []  # tag_id -> name
+        self._incidence = scipy.sparse.csr_matrix((0, 0), dtype=numpy.int64)
+        self._cooccurrence = scipy.sparse.csr_matrix((0, 0), dtype=numpy.int64)
+        self._bookmarks = numpy.zeros(0, dtype=numpy.float64)
+        self._cache = {}
+
+    def refresh(self) -> int:
+        """Read new rows of illust_tag and update matrices
+
+        Returns:
+            int: Number of new (tag, illust) rows
+        """
+        with self._lock:
+            generation = self.db.generation
+            if generation == self._generation:
+                return 0
+
+            pairs = [pair for chunk in self.db.iter_illust_tags(self._position) for pair in chunk]
+            # all rows are read again when shards of database changed
+            if self._position.pop("reset", False):
+                self._reset()
+            self._generation = generation
+
+            for tag_id, name in self.db("SELECT id, name FROM tag_name WHERE id >= ? ORDER BY id;", (len(self._names),)):
+                self._names.extend([None] * (tag_id + 1 - len(self._names)))
+                self._names[tag_id] = name
+
+            new_ids = self._add_pairs(pairs) if pairs else []
+            self._update_bookmarks(new_ids)
+            self._cache.clear()
+            return len(pairs)
+
+    def _add_pairs(self, pairs) -> list:
+        """Returns: ids of illusts new to A"""
+        new_ids = []
+        for _, illust_id in pairs:
+            if illust_id not in self._rows:
+                self._rows[illust_id] = len(self._rows)
+                new_ids.append(illust_id)
+        shape = (len(self._rows), len(self._names))
+        tag_ids = numpy.fromiter((pair[0] for pair in pairs), dtype=numpy.int64, count=len(pairs))
+        rows = numpy.fromiter((self._rows[pair[1]] for pair in pairs), dtype=numpy.int64, count=len(pairs))
+        delta = scipy.sparse.csr_matrix((numpy.ones(len(pairs), dtype=numpy.int64), (rows, tag_ids)), shape=shape)
+
+        incidence = self._incidence.copy()
+        incidence.resize(shape)
+        cooccurrence = self._cooccurrence.copy()
+        cooccurrence.resize((shape[1], shape[1]))
+        cross = (incidence.T @ delta).tocsr()
+        self._cooccurrence = (cooccurrence + cross + cross.T + delta.T @ delta).tocsr()
+        self._incidence = incidence + delta
+        return new_ids
+
+    def _update_bookmarks(self, new_ids):
+        bookmarks = numpy.zeros(len(self._rows), dtype=numpy.float64)
+        bookmarks[:len(self._bookmarks)] = self._bookmarks
+        rows = self.db(
+            "SELECT id, bookmark_count, last_update_date FROM illust WHERE last_update_date >= ?;", (self._bookmark_since,)
+        )
+        # new illusts may have older dates, e.g. merged by import_tables, or their tags were written after the illust
+        illust_ids = self._unknown_bookmarks.union(new_ids).difference(row[0] for row in rows)
+        illust_ids = list(illust_ids)
+        for i in range(0, len(illust_ids), 500):
+            chunk = illust_ids[i: i + 500]
+            rows.extend(self.db(
+                "SELECT id, bookmark_count, last_update_date FROM illust WHERE id IN ({});".format(", ".join("?" * len(chunk))),
+                chunk
+            ))
+
+        found = set()
+        for illust_id, bookmark_count, last_update_date in rows:
+            row = self._rows.get(illust_id)
+            if row is not None:
+                bookmarks[row] = bookmark_count
+                found.add(illust_id)
+            self._bookmark_since = max(self._bookmark_since, last_update_date)
+        self._unknown_bookmarks = set(illust_ids).difference(found)
+        self._bookmarks = bookmarks
+
+    def _cached(self, key, func):
+        with self._lock:
+            if self.auto_refresh:
+                self.refresh()
+            if key not in self._cache:
+                self._cache[key] = func()
+            return self._cache[key]
+
+    def _tag_id(self, name) -> int:
+        row = self.db("SELECT id FROM tag_name WHERE name = ?;", (name,))
+        if not row or row[0][0] >= self._cooccurrence.shape[0]:
+            return None
+        return row[0][0]
+
+    def _top(self, scores, top: int, exclude=None) -> list:
+        if exclude is not None:
+            scores[exclude] = -numpy.inf
+        top = min(top, int(numpy.isfinite(scores).sum()))
+        if top <= 0:
+            return []
+        indexes = numpy.argpartition(-scores, top - 1)[:top]
+        indexes = indexes[numpy.argsort(-scores[indexes], kind="stable")]
+        return [(self._names[i], float(scores[i])) for i in indexes]
+
+    def tag_counts(self) -> dict:
+        """Returns: {tag name: number of illusts}"""
+        def func():
+            counts = self._cooccurrence.diagonal()
+            return {self._names[i]: int(counts[i]) for i in counts.nonzero()[0]}
+        return self._cached(("tag_counts",), func)
+
+    def cooccurrence(self, name, top: int = 20) -> list:
+        """Tags most often on the same illusts as tag name
+
+        Returns:
+            list: [(tag name, number of illusts with both tags), ...]
+        """
+        def func():
+            tag_id = self._tag_id(name)
+            if tag_id is None:
+                return []
+            scores = self._cooccurrence.getrow(tag_id).toarray().ravel().astype(numpy.float64)
+            scores[scores == 0] = -numpy.inf
+            return [(tag, int(count)) for tag, count in self._top(scores, top, tag_id)]
+        return self._cached(("cooccurrence", name, top), func)
+
+    def related_tags(self, name, top: int = 20, min_count: int = 3) -> list:
+        """Tags related to tag name, ranked by pointwise mutual information
+
+        PMI = log(P(x, y) / (P(x) * P(y))), tags on fewer than min_count illusts with name are ignored,
+        as PMI overrates rare tags.
+
+        Returns:
+            list: [(tag name, pmi), ...]
+        """
+        def func():
+            tag_id = self._tag_id(name)
+            if tag_id is None:
+                return []
+            counts = self._cooccurrence.diagonal().astype(numpy.float64)
+            joint = self._cooccurrence.getrow(tag_id).toarray().ravel().astype(numpy.float64)
+            valid = joint >= min_count
+            scores = numpy.full(len(joint), -numpy.inf)
+            scores[valid] = numpy.log(joint[valid] * len(self._rows) / (counts[tag_id] * counts[valid]))
+            return self._top(scores, top, tag_id)
+        return self._cached(("related_tags", name, top, min_count), func)
+
+    def popular_tags(self, top: int = 50, weighted: bool = True) -> list:
+        """Most popular tags
+
+        Args:
+            weighted: Score a tag by total bookmarks of its illusts, else by number of its illusts
+
+        Returns:
+            list: [(tag name, score), ...]
+        """
+        def func():
+            if weighted:
+                scores = self._incidence.T @ self._bookmarks
+            else:
+                scores = self._cooccurrence.diagonal().astype(numpy.float64)
+            scores = numpy.asarray(scores, dtype=numpy.float64).ravel()
+            scores[scores == 0] = -numpy.inf
+            return self._top(scores, top)
+        return self._cached(("popular_tags", top, weighted), func)
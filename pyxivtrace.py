@@ -0,0 +1,204 @@
+import atexit
+import json
+import os
+import random
+import threading
+from functools import wraps
+from time import perf_counter_ns
+
+
+class _NullSpan:
+    """Span used when tracing is disabled or not sampled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class _SkippedSpan:
+    """Root span not sampled, spans in it are skipped"""
+
+    __slots__ = ("tracer",)
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def __enter__(self):
+        self.tracer._local.skipped += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer._local.skipped -= 1
+        return False
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start", "children")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.children = 0  # ns spent in child spans
+
+    def __enter__(self):
+        self.tracer._local.stack.append(self)
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = perf_counter_ns()
+        stack = self.tracer._local.stack
+        stack.pop()
+        duration = end - self.start
+        if stack:
+            stack[-1].children += duration
+        self.tracer._finish(self, duration)
+        return False
+
+
+class PyxivTracer:
+    """Record nested spans of time, and write them as Chrome trace events
+
+    Spans of each thread are nested by a stack, a root span and all spans in it are sampled together.
+    Open the written json in chrome://tracing or https://ui.perfetto.dev
+
+    Example:
+        tracer.enable("trace.json", sample_rate=0.1)
+        with tracer.span("http", url=url):
+            ...
+
+    Note:
+        Self time of a span is its duration minus time of its child spans,
+        so breakdown() adds up to the traced time without double counting.
+    """
+
+    def __init__(self, max_events: int = 10**6):
+        """
+        Args:
+            max_events: Max number of events to keep for write, breakdown still counts all spans
+        """
+        self.max_events = max_events
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.path = None
+        self.events = []
+        self.phases = {}  # name -> [count, total ns, self ns]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin = perf_counter_ns()
+
+    def enable(self, path=None, sample_rate: float = 1.0):
+        """Start tracing
+
+        Args:
+            path: Write trace events to path and print breakdown at exit, None to call write and report manually
+            sample_rate: Fraction of root spans to trace
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError("Incorrect sample_rate value: {}".format(sample_rate))
+        self.sample_rate = sample_rate
+        self.enabled = True
+        if path and self.path is None:
+            atexit.register(self._write_at_exit)
+        self.path = path
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.events = []
+            self.phases = {}
+
+    def span(self, name, **args):
+        """A context manager to trace the time in it as a span named name, args are shown in trace viewer"""
+        if not self.enabled:
+            return _null_span
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+            self._local.skipped = 0
+        if not stack:
+            # sample by root span, skip all spans in an unsampled root
+            if self._local.skipped or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+                return _SkippedSpan(self)
+        return _Span(self, name, args)
+
+    def _finish(self, span: _Span, duration: int):
+        with self._lock:
+            phase = self.phases.get(span.name)
+            if phase is None:
+                phase = self.phases[span.name] = [0, 0, 0]
+            phase[0] += 1
+            phase[1] += duration
+            phase[2] += duration - span.children
+            if len(self.events) < self.max_events:
+                self.events.append({
+                    "name": span.name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": (span.start - self._origin) / 1000, "dur": duration / 1000, "args": span.args,
+                })
+
+    def breakdown(self) -> dict:
+        """Time of each span name, most self time first
+
+        Returns:
+            dict: {name: {"count", "total", "self"}}, times in seconds
+        """
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda e: e[1][2], reverse=True)
+        return {name: {"count": count, "total": total / 1e9, "self": self_ / 1e9} for name, (count, total, self_) in phases}
+
+    def report(self) -> str:
+        breakdown = self.breakdown()
+        traced = sum(e["self"] for e in breakdown.values())
+        lines = ["Trace: {:.1f}s in spans, sample rate {}".format(traced, self.sample_rate)]
+        for name, e in breakdown.items():
+            lines.append("  {}: {:.3f}s self ({:.1%}), {:.3f}s total, {} spans".format(
+                name, e["self"], e["self"] / traced if traced else 0.0, e["total"], e["count"]
+            ))
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Write trace events in Chrome trace event format"""
+        with self._lock:
+            events = list(self.events)
+        thread_names = [
+            {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread.ident, "args": {"name": thread.name}}
+            for thread in threading.enumerate()
+        ]
+        with open(path, "w", encoding="utf8") as f:
+            json.dump({"traceEvents": thread_names + events, "displayTimeUnit": "ms"}, f, default=str)
+
+    def _write_at_exit(self):
+        if self.path and self.phases:
+            self.write(self.path)
+            print(self.report())
+
+
+# tracer shared by all modules, disabled by default
+tracer = PyxivTracer()
+
+
+def span(name, **args):
+    return tracer.span(name, **args)
+
+
+def traced(name: str = None):
+    """Trace calls of a function as spans named name, default to qualified name of the function"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @wraps(func)
+        def decorated_func(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+        return decorated_func
+    return decorator
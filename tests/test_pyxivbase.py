@@ -0,0 +1,43 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from pyxivbase import PyxivDatabase
+
+
+class TestFindSimilarPages(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = PyxivDatabase(str(Path(self.tmp_dir.name, "pyxiv.db")))
+        self.hash_ = 0x8123456789ABCDEF
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp_dir.cleanup()
+
+    def test_exact_duplicate(self):
+        self.db.insert_page_hash(1, 0, self.hash_, True).result()
+        for max_distance in range(9):
+            self.assertEqual(self.db.find_similar_pages(self.hash_, max_distance), [(1, 0, 0)], max_distance)
+
+    def test_duplicate_differing_in_one_chunk(self):
+        self.db.insert_page_hash(1, 0, self.hash_ ^ 0xF, True).result()
+        self.assertEqual(self.db.find_similar_pages(self.hash_, 4), [(1, 0, 4)])
+        self.assertEqual(self.db.find_similar_pages(self.hash_, 3), [])
+
+
+class TestReaders(unittest.TestCase):
+    def test_reader_closed_when_thread_ends(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = PyxivDatabase(str(Path(tmp_dir, "pyxiv.db")))
+            for _ in range(20):
+                thread = threading.Thread(target=db, args=("SELECT COUNT(*) FROM illust;",))
+                thread.start()
+                thread.join()
+            self.assertEqual(len(db._readers), 0)
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
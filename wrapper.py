@@ -1,6 +1,7 @@
 import logging
 import sqlite3
 import sys
+from concurrent.futures import Future
 from functools import wraps
 from time import sleep
 from urllib.parse import urlparse, urlunparse
@@ -73,26 +74,81 @@ def cookies_required():
     return decorator
 
 
-def log_calling_info(log_file=sys.stdout):
-    """Log method calling info."""
+def log_calling_info(log_file=None):
+    """Log method calling info, to sys.stdout at calling time if log_file is None."""
     def decorator(method):
         @wraps(method)
         def decorated_method(self, *args, **kwargs):
             info_msg = "Calling Func:{}:{}:{}".format(method.__name__, args, kwargs)
-            print(info_msg, file=log_file)
+            print(info_msg, file=log_file or sys.stdout)
             return method(self, *args, **kwargs)
         return decorated_method
     return decorator
 
 
 def database_operation():
+    """Log and reraise sqlite3.Error of a database method."""
     def decorator(method):
         @wraps(method)
         def decorated_method(self, *args, **kwargs):
             try:
                 return method(self, *args, **kwargs)
             except sqlite3.Error as e:
-                logging.getLogger(__name__).error("Failed to Execute:{}:{}:{}".format(method.__name__, args, kwargs))
-                return []
+                logging.getLogger(__name__).error("Failed to Execute:{}:{}:{}:{}".format(method.__name__, args, kwargs, e))
+                raise
+        return decorated_method
+    return decorator
+
+
+def database_write():
+    """Run method(self, connection, *args, **kwargs) in writer thread of database,
+    the decorated method(self, *args, **kwargs) returns a Future of the result.
+    """
+    def decorator(method):
+        @wraps(method)
+        def decorated_method(self, *args, **kwargs):
+            def func(connection):
+                try:
+                    return method(self, connection, *args, **kwargs)
+                except sqlite3.Error as e:
+                    logging.getLogger(__name__).error("Failed to Execute:{}:{}:{}:{}".format(method.__name__, args, kwargs, e))
+                    raise
+            return self._submit(func)
+        return decorated_method
+    return decorator
+
+
+def singleflight():
+    """Share one call of a method among concurrent calls with the same arguments.
+
+    Callers arriving while a call is in flight wait for it, and get its result or raise its exception.
+    The instance needs _flights dict, _flights_lock and flight_counts {"calls", "coalesced"}.
+    The result is shared by all callers, so it should not be modified.
+    """
+    def decorator(method):
+        @wraps(method)
+        def decorated_method(self, *args, **kwargs):
+            key = (method.__name__, args, tuple(sorted(kwargs.items())))
+            with self._flights_lock:
+                self.flight_counts["calls"] += 1
+                future = self._flights.get(key)
+                leader = future is None
+                if leader:
+                    future = self._flights[key] = Future()
+                else:
+                    self.flight_counts["coalesced"] += 1
+            if not leader:
+                return future.result()
+
+            try:
+                result = method(self, *args, **kwargs)
+                future.set_result(result)
+                return result
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self._flights_lock:
+                    del self._flights[key]
         return decorated_method
     return decorator